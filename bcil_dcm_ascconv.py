@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# coding:utf-8
+import hashlib
+from typing import Optional, Union
+
+
+ASCCONV_BEGIN: bytes = b"### ASCCONV BEGIN"
+ASCCONV_BEGIN_LINE_END: bytes = b"###\n"
+ASCCONV_END: bytes = b"\n### ASCCONV END ###"
+
+# (blob hash, keys) -> 解析結果
+ASCCONV_CACHE_SIZE: int = 256
+_ascconv_cache: dict = {}
+
+
+def parse_ascconv(blob: Union[bytes, str], keys: Optional[list] = None) -> Optional[dict]:
+    # 同一プロトコルの blob は hash でキャッシュした結果を返す
+    if isinstance(blob, str):
+        blob = blob.encode("utf-8")
+    key_set = frozenset(keys) if keys is not None else None
+    cache_key = (hashlib.sha1(blob).digest(), key_set)
+    if cache_key in _ascconv_cache:
+        result = _ascconv_cache[cache_key]
+        return None if result is None else dict(result)
+
+    result = scan_ascconv(blob, key_set)
+    if len(_ascconv_cache) >= ASCCONV_CACHE_SIZE:
+        del _ascconv_cache[next(iter(_ascconv_cache))]  # 古いものから削除
+    _ascconv_cache[cache_key] = result
+    return None if result is None else dict(result)
+
+
+def scan_ascconv(blob: bytes, key_set: Optional[frozenset] = None) -> Optional[dict]:
+    # 最初の ASCCONV BEGIN 行の次から ASCCONV END までのみ走査する
+    begin = blob.find(ASCCONV_BEGIN)
+    if begin < 0:
+        return None
+    start = blob.find(ASCCONV_BEGIN_LINE_END, begin + len(ASCCONV_BEGIN))
+    if start < 0:
+        return None
+    start += len(ASCCONV_BEGIN_LINE_END)
+    end = blob.find(ASCCONV_END, start)
+    if end < 0:
+        return None
+
+    key_bytes_set = None if key_set is None else frozenset(k.encode("utf-8") for k in key_set)
+    result = {}
+    for line in blob[start:end].split(b"\n"):
+        tmp = line.replace(b"\t", b"").split(b"=")
+        if len(tmp) != 2:
+            continue
+        key = tmp[0].strip(b" ").strip(b'"')
+        if key_bytes_set is not None and key not in key_bytes_set:
+            continue
+        result[key.decode("utf-8", errors="replace")] = tmp[1].strip(b" ").strip(b'"').decode("utf-8", errors="replace")
+    return result
@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+# coding:utf-8
+import hashlib
+import os
+import random
+import re
+import tempfile
+import time
+from typing import Callable, NoReturn, Optional, Union
+
+import pandas as pd
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+from bcil_dcm_kspace_info import BcilDcmKspaceInfo
+from bcil_dcm_convert_csv import DcmCsvData
+from bcil_dcm_convert_nifti import NiftiMatcher
+from bcil_dcm_convert_criteria import DcmCriteriaMatcher
+from fnmatch import fnmatch
+
+
+ASCCONV_SAMPLE: bytes = (
+    b"### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=51130001 ###\n"
+    b"ulVersion\t = 0x14b44b6\n"
+    b"sRXSPEC.alDwellTime[0]\t = 2600\n"
+    b"sPat.lAccelFactPE\t = 2\n"
+    b"sWipMemBlock.alFree[13]\t = 8\n"
+    b"sTXSPEC.asNucleusInfo[0].flReferenceAmplitude\t = 250.5\n"
+    b"ucFlipAngleMode\t = 0x10\n"
+    b"sKSpace.ucPhasePartialFourier\t = 16\n"
+    b"sKSpace.ucSlicePartialFourier\t = 8\n"
+    b"### ASCCONV END ###\n"
+)
+
+
+class LegacyKspaceInfo(BcilDcmKspaceInfo):
+    # 変更前の BcilDcmKspaceInfo (インスタンス毎にファイルを再読み込みし、
+    # 参照毎に Dataset をコピーして辿り、ASCCONV を正規表現で毎回全て parse する)
+
+    def __init__(self, file_path: str):
+        super().__init__(file_path)
+
+    def get_ds_val(self, name: str, keys: list, type_str: str = "str") -> Union[list, str]:
+        t = self.ds.copy()
+        for key in keys:
+            if key in t:
+                if type(t[key].value) == pydicom.sequence.Sequence:
+                    t = t[key].value[0]
+                else:
+                    t = t[key].value
+            else:
+                search = list(map(
+                    lambda s: "(" + s[2:6] + "," + s[6:] + ")" if len(s) == 10 and s[:2] == "0x" else s, keys))
+                self.logger.warning("Warning: not found {}. no {} in dcm header .".format(name, "-".join(search)))
+                return None
+        if type_str == "list":
+            return list(t)
+        else:
+            return str(t)
+
+    def set_ascii_txt(self, place: list) -> NoReturn:
+        raw_string = self.get_ds_val("ascii_text", place)
+        if raw_string is not None:
+            try:
+                m = re.findall(r"((### ASCCONV BEGIN)(.*?)(###\\n))(.*?)(\\n### ASCCONV END ###)", raw_string)
+                if len(m) == 0 or m[0][4] is not None:
+                    tmp = m[0]
+                    ascconv = re.sub(r'\\n', "\n", tmp[4], 0, re.MULTILINE)
+                    ascconv = re.sub(r'\\t', "", ascconv, 0, re.MULTILINE)
+                    result = {}
+                    for line in ascconv.splitlines():
+                        tmp = line.split(r"=")
+                        if len(tmp) == 2:
+                            result[tmp[0].strip(" ").strip('"')] = tmp[1].strip(" ").strip('"')
+                    self.ascii_data = result
+            except Exception as e:
+                self.logger.error("Error: cannot get ascii text. " + str(e))
+
+
+def gen_enhanced_mr_ds(n_frames: int) -> Dataset:
+    # XA Enhanced MR (multi-frame) を模した Dataset
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4.1"
+    ds.file_meta.MediaStorageSOPInstanceUID = "1.2.3.4.5.6.7.8.9"
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.Manufacturer = "SIEMENS"
+    ds.SoftwareVersions = "syngo MR XA30"
+
+    csa_shared = Dataset()
+    csa_shared.add_new(0x00211019, "OB", ASCCONV_SAMPLE)
+    csa_shared.add_new(0x00211033, "SH", "AS82")
+    mr_fov = Dataset()
+    mr_fov.add_new(0x00181312, "CS", "COL")
+    shared = Dataset()
+    shared.add_new(0x002110fe, "SQ", Sequence([csa_shared]))
+    shared.add_new(0x00189125, "SQ", Sequence([mr_fov]))
+    ds.add_new(0x52009229, "SQ", Sequence([shared]))
+
+    frames = []
+    for i in range(n_frames):
+        csa_frame = Dataset()
+        csa_frame.add_new(0x00211158, "SH", "64p*64")
+        csa_frame.add_new(0x00211153, "FD", 20.0)
+        csa_frame.add_new(0x0021111c, "IS", 1)
+        csa_frame.add_new(0x00211175, "CS", ["ORIGINAL", "PRIMARY", "M", "ND"])
+        orientation = Dataset()
+        orientation.add_new(0x00200037, "DS", [1, 0, 0, 0, 1, 0])
+        position = Dataset()
+        position.add_new(0x00200032, "DS", [-100.0, -100.0, float(i)])
+        frame = Dataset()
+        frame.add_new(0x002111fe, "SQ", Sequence([csa_frame]))
+        frame.add_new(0x00209116, "SQ", Sequence([orientation]))
+        frame.add_new(0x00209113, "SQ", Sequence([position]))
+        frames.append(frame)
+    ds.add_new(0x52009230, "SQ", Sequence(frames))
+    return ds
+
+
+def run_kspace_info(cls: type, path: str, ds: Optional[Dataset] = None) -> tuple:
+    k = cls(path) if ds is None else cls(path, ds)
+    k.setup_file_logger(os.devnull)
+    k.main()
+    return k.output
+
+
+def measure(func: Callable, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_kspace_info(frames_list: list, repeat: int):
+    print("BcilDcmKspaceInfo per-series extraction (Enhanced MR)")
+    for n_frames in frames_list:
+        # 変更前はファイルを再読み込みし、変更後は header の読み込み時の FileDataset を受け取る
+        with tempfile.TemporaryDirectory() as tmp_d:
+            path = os.path.join(tmp_d, "enhanced_mr.dcm")
+            pydicom.dcmwrite(path, gen_enhanced_mr_ds(n_frames), write_like_original=False)
+            ds = pydicom.read_file(path)
+            if run_kspace_info(LegacyKspaceInfo, path) != run_kspace_info(BcilDcmKspaceInfo, path, ds):
+                print("Error: output mismatch. frames=" + str(n_frames))
+                exit(1)
+            before = measure(lambda: run_kspace_info(LegacyKspaceInfo, path), repeat)
+            after = measure(lambda: run_kspace_info(BcilDcmKspaceInfo, path, ds), repeat)
+        print("frames: {:>6}  before: {:>9.3f} ms  after: {:>9.3f} ms  x{:.1f}".format(
+            n_frames, before * 1000, after * 1000, before / after))
+
+
+def run_csv_unique(keys: list, legacy: bool) -> DcmCsvData:
+    d = DcmCsvData()
+    for key in keys:
+        if legacy is True:
+            found = key in d.get_unique_col()  # 変更前 (list のコピー + 線形探索)
+        else:
+            found = d.has_unique(key)
+        if not found:
+            d.add_row_dict({"Series Number": 1, "Instance Number": 1, "File path": key, "Series UID": "1.2.3"})
+    return d
+
+
+def bench_csv_unique(records_list: list, legacy_max: int):
+    print("BaseCsvData unique key check + add_row (DcmCsvData)")
+    for n_records in records_list:
+        keys = ["/data/dcm/{:08d}.dcm".format(i // 2) for i in range(n_records)]  # 各キー 2 回
+        after = measure(lambda: run_csv_unique(keys, False), 1)
+        before = "{:>9.3f} s".format(measure(lambda: run_csv_unique(keys, True), 1)) \
+            if n_records <= legacy_max else "{:>11}".format("skipped")
+        print("records: {:>8}  before: {}  after: {:>9.3f} s  ({:.3f} us/record)".format(
+            n_records, before, after, after / n_records * 1000000))
+
+
+def bench_table_read(records_list: list, repeat: int):
+    print("DICOMlist load (read_csv + astype / read_table / read_table zero_copy)")
+    d = DcmCsvData()
+    if not d.table_available():
+        print("Error: pyarrow is not installed.")
+        exit(1)
+    for n_records in records_list:
+        with tempfile.TemporaryDirectory() as tmp_d:
+            df = pd.DataFrame({
+                "Series Number": [i // 1000 for i in range(n_records)],
+                "Instance Number": [i % 1000 + 1 for i in range(n_records)],
+                "File path": ["/data/dcm/{:08d}.dcm".format(i) for i in range(n_records)],
+                "Series UID": ["1.3.12.2.1107.5.2.43.166003.{:030d}".format(i // 1000) for i in range(n_records)],
+            }).astype(d.d_type)
+            csv_path = os.path.join(tmp_d, "DICOMlist.csv")
+            table_path = os.path.join(tmp_d, "DICOMlist.feather")
+            d.save_csv(csv_path, df)
+            d.save_table(table_path, df)
+            if not d.read_csv(csv_path).astype(d.d_type).equals(d.read_table(table_path)):
+                print("Error: output mismatch. records=" + str(n_records))
+                exit(1)
+            before = measure(lambda: d.read_csv(csv_path).astype(d.d_type), repeat)
+            after = measure(lambda: d.read_table(table_path), repeat)
+            zero_copy = measure(lambda: d.read_table(table_path, zero_copy=True), repeat)
+        print("records: {:>8}  csv: {:>9.3f} ms  table: {:>9.3f} ms (x{:.1f})  zero_copy: {:>9.3f} ms (x{:.1f})".format(
+            n_records, before * 1000, after * 1000, before / after, zero_copy * 1000, before / zero_copy))
+
+
+def run_nifti_match_legacy(raw_data_files: list, bids_files: list) -> dict:
+    # 変更前 (ファイル全体を読み込んで全ファイルの hash を計算する)
+    bids_hash = {}
+    for f in bids_files:
+        bids_hash[hashlib.sha256(open(f, 'rb').read()).hexdigest()] = f
+    return dict([(f, bids_hash.get(hashlib.sha256(open(f, 'rb').read()).hexdigest())) for f in raw_data_files])
+
+
+def bench_nifti_match(files_list: list, file_size: int):
+    print("RawData -> BIDS NIFTI matching (legacy / NiftiMatcher / NiftiMatcher with cache)")
+    for n_files in files_list:
+        with tempfile.TemporaryDirectory() as tmp_d:
+            raw_data_files, bids_files = [], []
+            for i in range(n_files):
+                # 半数は同じサイズ (hash が必要)、残りはサイズが一意
+                size = file_size if i % 2 == 0 else file_size + i
+                raw_data_files.append(os.path.join(tmp_d, "raw_{:04d}.nii.gz".format(i)))
+                bids_files.append(os.path.join(tmp_d, "bids_{:04d}.nii.gz".format(i)))
+                data = os.urandom(size)
+                for f in [raw_data_files[-1], bids_files[-1]]:
+                    with open(f, mode="wb") as fp:
+                        fp.write(data)
+            expected = run_nifti_match_legacy(raw_data_files, bids_files)
+            before = measure(lambda: run_nifti_match_legacy(raw_data_files, bids_files), 1)
+
+            matcher = NiftiMatcher(tmp_d)
+            start = time.perf_counter()
+            result = matcher.match(raw_data_files, bids_files)
+            after = time.perf_counter() - start
+            start = time.perf_counter()
+            cached = matcher.match(raw_data_files, bids_files)
+            after_cached = time.perf_counter() - start
+            matcher.close()
+            if result != expected or cached != expected:
+                print("Error: output mismatch. files=" + str(n_files))
+                exit(1)
+        print("files: {:>5} x {} MB  before: {:>8.3f} s  after: {:>8.3f} s (x{:.1f})  cached: {:>8.3f} s (x{:.1f})".format(
+            n_files, file_size // (1024 * 1024), before, after, before / after, after_cached, before / after_cached))
+
+
+def run_criteria_legacy(descriptions: list, data: dict) -> list:
+    # 変更前 (dcm2bids と同じく description 毎に全 criteria を fnmatch で照合する)
+    found = []
+    for i, description in enumerate(descriptions):
+        result = []
+        for tag, pattern in description["criteria"].items():
+            name = data.get(tag, "")
+            if isinstance(name, list):
+                sub = [isinstance(pattern, list) and len(name) == len(pattern)]
+                sub.extend([fnmatch(str(n), str(p)) for n, p in zip(name, pattern)] if sub[0] else [])
+                result.append(all(sub))
+            else:
+                result.append(fnmatch(str(name), str(pattern)))
+        if all(result):
+            found.append(i)
+    return found
+
+
+def bench_criteria(descriptions_list: list, n_series: int):
+    print("dcm2bids criteria matching (legacy fnmatch loop / DcmCriteriaMatcher)")
+    rnd = random.Random(0)
+    image_types = [["ORIGINAL", "PRIMARY", "M", "ND", "NORM"], ["ORIGINAL", "PRIMARY", "P", "ND", "PHASE"]]
+    for n_descriptions in descriptions_list:
+        descriptions = []
+        for i in range(n_descriptions):
+            criteria = {
+                "SeriesDescription": "PROT_{}".format(i) if i % 10 != 0 else "PROT_{}_*".format(i),
+                "SequenceName": "*seq{}".format(i % 50),
+                "ImageType": image_types[i % 2],
+            }
+            descriptions.append({"dataType": "anat", "modalityLabel": "T1w", "criteria": criteria})
+        series = []
+        for _ in range(n_series):
+            i = rnd.randrange(n_descriptions * 2)  # 半数は一致しない
+            series.append({
+                "SeriesDescription": "PROT_{}".format(i) + ("_ND" if i % 10 == 0 else ""),
+                "SequenceName": "*seq{}".format(i % 50),
+                "ImageType": image_types[rnd.randrange(2)],
+            })
+        matcher = DcmCriteriaMatcher(descriptions)
+        if [run_criteria_legacy(descriptions, d) for d in series] != [matcher.match(d) for d in series]:
+            print("Error: output mismatch. descriptions=" + str(n_descriptions))
+            exit(1)
+        before = measure(lambda: [run_criteria_legacy(descriptions, d) for d in series], 1)
+        compile_time = measure(lambda: DcmCriteriaMatcher(descriptions), 1)
+        after = measure(lambda: [matcher.match(d) for d in series], 1)
+        print("descriptions: {:>5}  series: {}  before: {:>9.3f} ms  after: {:>9.3f} ms (x{:.1f})  "
+              "compile: {:>7.3f} ms".format(n_descriptions, n_series, before * 1000, after * 1000, before / after,
+                                             compile_time * 1000))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 bcil_dcm_benchmark.py kspace\n" \
+        "       $ python3 bcil_dcm_benchmark.py csv\n" \
+        "       $ python3 bcil_dcm_benchmark.py table\n" \
+        "       $ python3 bcil_dcm_benchmark.py nifti\n" \
+        "       $ python3 bcil_dcm_benchmark.py criteria\n" \
+        "\n\n" \
+        "".format(__file__)
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('target', type=str, choices=["kspace", "csv", "table", "nifti", "criteria"])
+    ap.add_argument('-r', dest='repeat', type=int, default=20, help="number of repetitions (default is 20)")
+    args = ap.parse_args()
+
+    if args.target == "kspace":
+        bench_kspace_info([100, 1000, 5000], args.repeat)
+    elif args.target == "csv":
+        bench_csv_unique([1000, 10000, 100000, 1000000], 10000)
+    elif args.target == "table":
+        bench_table_read([10000, 100000, 1000000], min(args.repeat, 5))
+    elif args.target == "nifti":
+        bench_nifti_match([10, 40], 32 * 1024 * 1024)
+    elif args.target == "criteria":
+        bench_criteria([24, 200, 1000], 1000)
@@ -2,7 +2,9 @@
 # coding:utf-8
 from bcil_dcm_kspace_info import BcilDcmKspaceInfo
 import glob
+import itertools
 import os
+import numpy as np
 import pandas as pd
 import platform
 import pydicom
@@ -14,22 +16,57 @@ import sys
 import tqdm
 from typing import Optional, Final, NoReturn, List
 import zipfile
+import posixpath
 import datetime
-from collections import namedtuple, Counter
+import concurrent.futures
+import time
+from collections import namedtuple
 
 import bcil_dcm_convert_logger
-from bcil_dcm_convert_csv import SeriesCsvData, StudyCsvData, DcmCsvData
+from bcil_dcm_convert_csv import BaseCsvData, SeriesCsvData, StudyCsvData, DcmCsvData
+from bcil_dcm_convert_index import DcmHeaderIndex, DcmAppendIndex
+from bcil_dcm_convert_catalog import DcmCatalog
+from bcil_dcm_convert_criteria import DcmCriteriaMatcher
 
 
 class BcilDcmConvert:
 
     init_error = True
+    close_message: Optional[str] = None  # close() で終了した際のメッセージ
 
     __version__: Final[str] = "3.2.0"
     last_update: Final[str] = "20240524001"
 
     DCM_2_NIIX_CMD: Final[str] = "dcm2niix"
     DCM_2_NAMING_RULE: Final[str] = "%s_%d"
+    dcm2niix_version: Optional[str] = None
+
+    # header scan: tags read from every file (series/study keys, study naming rule and PixelData element header)
+    DCM_HEADER_TAGS: Final[list] = [
+        0x00080070,  # Manufacturer
+        0x00100010,  # Patient Name
+        0x00100020,  # Patient ID
+        0x0020000d,  # Study UID
+        0x0020000e,  # Series UID
+        0x00200010,  # Study ID
+        0x00200011,  # Series Number
+        0x00200013,  # Instance Number
+        0x0051100f,  # Coil (Siemens)
+        0x7fe00010,  # PixelData (value deferred)
+    ]
+    DCM_HEADER_DEFER_SIZE: Final[int] = 1024
+    # header index に保存する内容 (scan_dcm_headers / read_series_rows の取得値) を変更した場合は上げる
+    HEADER_EXTRACT_VERSION: Final[str] = "1"
+
+    # finalize (別の file system への copy)
+    COPY_CHUNK_SIZE: Final[int] = 1024 * 1024 * 1024
+    COPY_BUFFER_SIZE: Final[int] = 8 * 1024 * 1024
+
+    DCM_FILE_EXT: Final[tuple] = (".ima", ".dcm", ".dic", ".dc3", ".dicom", ".IMA", ".DCM", ".DIC", ".DC3", ".DICOM")
+    # zip 内ファイルのパス表記 (<zip path>!/<member>)
+    ZIP_MEMBER_SEP: Final[str] = "!/"
+    zip_handles: dict = {}
+    work_id_counter: itertools.count = itertools.count(1)  # 同一プロセス内 (--split_study 等) の作業フォルダ id の連番
 
     def __init__(self,
                  dcm_dir_list: List[str],
@@ -38,13 +75,39 @@ class BcilDcmConvert:
                  overwrite: int = 0,
                  subject_name: Optional[str] = None,
                  gz: bool = False,
-                 working_folder: [str] = None):
+                 working_folder: [str] = None,
+                 jobs: int = 1,
+                 header_index: bool = False,
+                 zip_native: bool = False,
+                 dicm_check: bool = False,
+                 series_nifti: bool = False,
+                 dcm_list_memory: Optional[int] = None,
+                 compact_dcm_list: bool = False,
+                 feather: bool = False,
+                 catalog: bool = False,
+                 split_study: bool = False,
+                 bids_config: Optional[str] = None):
 
         self.dcm_dir_list = dcm_dir_list
         self.create_nifti = create_nifti
         self.overwrite = overwrite
         self.subject_name = subject_name
         self.gz = gz
+        self.jobs = max(1, jobs)
+        self.zip_native = zip_native
+        self.dicm_check = dicm_check
+        self.series_nifti = series_nifti
+        self.dcm_list_memory = dcm_list_memory
+        self.compact_dcm_list = compact_dcm_list
+        self.feather = feather
+        self.catalog = catalog
+        self.split_study = split_study
+        self.bids_config = bids_config
+        self.working_folder = working_folder
+        self.split_files = False  # split_study で分割した subject (DICOMlist のファイルのみ変換する)
+        self.study_last_files = {}  # Study UID 毎の最後に読んだファイル (split_study の naming rule 用)
+        self.zip_extract_dirs = {}  # extract_zip_members で展開した zip (zip path -> unzip path)
+        self.src_file_lists = {}  # unzip_exec で展開したファイル一覧 (unzip path -> files)
 
         # data
         self.series = SeriesCsvData()
@@ -61,6 +124,9 @@ class BcilDcmConvert:
         self.work_path = self.gen_bdc_path(self.work_base_path.subject_d)
         self.dst_path = None
 
+        # header index
+        self.header_index = DcmHeaderIndex(self.parent_d, self.HEADER_EXTRACT_VERSION) if header_index is True else None
+
         # log start
         self.logger = self.setup_logger()
         self.console_logger = bcil_dcm_convert_logger.get_stream_logger(identifier=self.work_base_path.bdc_id)
@@ -99,14 +165,17 @@ class BcilDcmConvert:
         lg.info("work_subject_folder: " + self.work_path.subject_d)
         if self.create_nifti is True:
             try:
-                res = subprocess.run([self.DCM_2_NIIX_CMD, "-v"], stdout=subprocess.PIPE)
-                lg.info("dcm2niix: " + res.stdout.splitlines()[-1].decode('UTF-8'))
+                if BcilDcmConvert.dcm2niix_version is None:  # 同じプロセス内では一度だけ確認する
+                    res = subprocess.run([self.DCM_2_NIIX_CMD, "-v"], stdout=subprocess.PIPE)
+                    BcilDcmConvert.dcm2niix_version = res.stdout.splitlines()[-1].decode('UTF-8')
+                lg.info("dcm2niix: " + BcilDcmConvert.dcm2niix_version)
             except Exception as e:
                 self.close("Error : dcm2niix test failure: " + str(e))
         return lg
 
     def close(self, message: str, exit_number: int = 1) -> NoReturn:
 
+        self.close_message = message
         if self.console_logger is not None:
             if exit_number == 1:
                 self.console_logger.critical(message)
@@ -155,37 +224,48 @@ class BcilDcmConvert:
 
     @staticmethod
     def gen_bdc_path(bdc_work_folder: str) -> tuple():
-        list_str = "subject_d raw_data_d study_csv series_csv dcm_csv nifti_d dicom_d log_d log_txt dcm_list"
+        list_str = "subject_d raw_data_d study_csv series_csv dcm_csv dcm_compact study_table series_table dcm_table " \
+                   "nifti_d dicom_d log_d log_txt dcm_list"
         bdc_path_list = namedtuple("bdc_path_list", list_str)
         subject_d = bdc_work_folder
         raw_data_d = os.path.join(subject_d, "RawData")
         study_csv = os.path.join(subject_d, "RawData", "Studyinfo.csv")
         series_csv = os.path.join(subject_d, "RawData", "Seriesinfo.csv")
         dcm_csv = os.path.join(subject_d, "RawData", "DICOMlist.csv")
+        dcm_compact = os.path.join(subject_d, "RawData", "DICOMlist.json")
+        study_table = os.path.join(subject_d, "RawData", "Studyinfo.feather")
+        series_table = os.path.join(subject_d, "RawData", "Seriesinfo.feather")
+        dcm_table = os.path.join(subject_d, "RawData", "DICOMlist.feather")
         nifti_d = os.path.join(subject_d, "RawData", "NIFTI")
         dicom_d = os.path.join(subject_d, "RawData", "DICOM")
         log_d = os.path.join(subject_d, "logs")
         log_txt = os.path.join(subject_d, "logs", "bcil_dcm_convert.log")
         dcm_list = os.path.join(subject_d, "dcm_list.txt")
         return bdc_path_list(
-            subject_d, raw_data_d, study_csv, series_csv, dcm_csv, nifti_d, dicom_d, log_d, log_txt, dcm_list)
+            subject_d, raw_data_d, study_csv, series_csv, dcm_csv, dcm_compact, study_table, series_table, dcm_table,
+            nifti_d, dicom_d, log_d, log_txt, dcm_list)
 
-    @staticmethod
-    def gen_work_base_path(work_folder: str) -> tuple():
+    @classmethod
+    def gen_work_base_path(cls, work_folder: str) -> tuple():
         work_folder + "bcil_dcm_convert_folder" + os.sep
         work_root = os.path.join(work_folder, "bcil_dcm_convert_folder")
         work_base_path_list = namedtuple("work_base_path_list", "bdc_id subject_d unzip_d link_d")
-        bdc_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        subject_d = os.path.join(work_root, "tmp", bdc_id)
-        unzip_d = os.path.join(work_root, bdc_id)
-        link_d = os.path.join(work_root, "tmp", bdc_id + "_link")
-        while os.path.exists(subject_d) or os.path.exists(unzip_d) or os.path.exists(link_d):
-            bdc_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-            subject_d = os.path.join(work_root, "tmp", bdc_id)
-            unzip_d = os.path.join(work_root, bdc_id)
-            link_d = os.path.join(work_root, "tmp", bdc_id + "_link")
         try:
-            os.makedirs(subject_d, exist_ok=True)
+            while True:
+                # 日時 + pid + 連番 (同一プロセス内でも 1 秒待たずに別の id になる)
+                bdc_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + "_" + str(os.getpid()) + "_" + \
+                    str(next(cls.work_id_counter))
+                subject_d = os.path.join(work_root, "tmp", bdc_id)
+                unzip_d = os.path.join(work_root, bdc_id)
+                link_d = os.path.join(work_root, "tmp", bdc_id + "_link")
+                if not os.path.exists(subject_d) and not os.path.exists(unzip_d) and not os.path.exists(link_d):
+                    try:
+                        # 同時に実行している他のプロセスと同じ bdc_id にならないよう、作成できた場合のみ使う
+                        os.makedirs(os.path.dirname(subject_d), exist_ok=True)
+                        os.mkdir(subject_d)
+                        break
+                    except FileExistsError:
+                        pass
             os.chmod(subject_d, 0o755)
         except Exception as e:
             print("Unable to create folder at specified location. (" + subject_d + ") " + str(e))
@@ -198,45 +278,153 @@ class BcilDcmConvert:
             self.close("Error : init error.")
             return False
 
+        if self.feather is True and not self.study.table_available():
+            self.close("Error : pyarrow is required to save Feather files. (pip install pyarrow)")
+            return False
+
         try:
             # check and unzip
             src_folders = self.check_src_dcm()
             # get dcm list
-            file_count = self.create_dcm_list(src_folders)
+            dcm_files = self.create_dcm_list(src_folders)
             # read dcm
-            naming_rule = self.read_dcm_header(file_count)
-            self.dst_path = self.set_dist_path(naming_rule)
+            naming_rule = self.read_dcm_header(dcm_files)
+            if self.bids_config is not None:
+                self.check_bids_criteria()
+            if self.split_study is True and len(self.study.df) > 1:
+                return self.convert_split_study(src_folders)
+            self.convert_subject(src_folders, naming_rule)
 
-            # save sample dcm
-            self.save_ex_dcm()
-            # save nifti
-            if self.create_nifti is True:
-                self.save_nifti(src_folders)
-            # save study csv
-            self.logger.info("Saving: Studyinfo.csv")
-            self.study.save_csv(self.work_path.study_csv, self.study.df)
+        finally:
+            self.close_zip_handles()
+            if self.header_index is not None:
+                self.header_index.close()
+            if self.console_logger is not None:
+                self.console_logger = bcil_dcm_convert_logger.disposal_logger(self.console_logger)
+            if self.logger is not None:
+                self.logger = bcil_dcm_convert_logger.disposal_logger(self.logger)
 
-            # save series csv
-            self.logger.info("Saving: Seriesinfo.csv")
-            self.series.save_csv(self.work_path.series_csv, self.series.df)
+        return True
 
-            # move tmp >> subject dir
-            self.move_subject()
+    def convert_subject(self, src_folders: List, naming_rule: dict):
+        # read_dcm_header 以降 (保存先の決定、dcm2niix、保存)
+        self.dst_path = self.set_dist_path(naming_rule)
 
-            self.rm_work_files()
-            self.logger.debug("Changing: permission of files")
-            self.permission_modify(self.dst_path.subject_d)
+        # save sample dcm
+        self.save_ex_dcm()
+        # save nifti
+        if self.create_nifti is True:
+            self.save_nifti(self.extract_zip_members(src_folders))
+        # save study csv
+        self.logger.info("Saving: Studyinfo.csv")
+        self.study.save_csv(self.work_path.study_csv, self.study.df)
+
+        # save series csv
+        self.logger.info("Saving: Seriesinfo.csv")
+        self.series.save_csv(self.work_path.series_csv, self.series.df)
+
+        if self.feather is True:
+            self.logger.info("Saving: Studyinfo.feather, Seriesinfo.feather, DICOMlist.feather")
+            self.study.save_table(self.work_path.study_table, self.study.df)
+            self.series.save_table(self.work_path.series_table, self.series.df)
+            self.dcm.save_table(self.work_path.dcm_table, self.dcm.df)
+
+        # move tmp >> subject dir
+        self.move_subject()
+
+        # catalog
+        if self.catalog is True:
+            self.update_catalog()
+
+        self.rm_work_files()
+        self.logger.debug("Changing: permission of files")
+        self.permission_modify(self.dst_path.subject_d)
+
+        self.logger.info("############## END BCIL_DCM_CONVERT ##############")
+
+    def convert_split_study(self, src_folders: List) -> bool:
+        # Study UID 毎に subject を分け、読み込み済みのヘッダを使って並列に変換する
+        study_uids = self.study.df["StudyUID"].tolist()
+        folder_names = self.get_split_folder_names(study_uids)
+        self.logger.info("Start: split study (" + str(len(study_uids)) + " studies. " + ", ".join(folder_names) + ")")
+        if os.path.exists(self.work_path.dcm_csv):  # 分割前の DICOMlist は使わない
+            os.remove(self.work_path.dcm_csv)
+        if os.path.exists(self.work_path.dcm_compact):
+            os.remove(self.work_path.dcm_compact)
+
+        children = []
+        for study_uid, folder_name in zip(study_uids, folder_names):
+            child = BcilDcmConvert(
+                dcm_dir_list=self.dcm_dir_list, save_parent_dir=self.parent_d, create_nifti=self.create_nifti,
+                overwrite=self.overwrite, subject_name=folder_name, gz=self.gz, working_folder=self.working_folder,
+                jobs=self.jobs, zip_native=self.zip_native, dicm_check=self.dicm_check,
+                series_nifti=self.series_nifti, dcm_list_memory=self.dcm_list_memory,
+                compact_dcm_list=self.compact_dcm_list, feather=self.feather, catalog=self.catalog)
+            child.set_split_study(self, study_uid)
+            children.append(child)
+
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(children), os.cpu_count() or 1)) as executor:
+            for child, ok in zip(children, executor.map(lambda c: c.convert_split_child(src_folders), children)):
+                self.logger.info(" " + ("ok" if ok is True else "failed") + ": " + child.study.df["StudyUID"][0] +
+                                 " > " + (child.dst_path.subject_d if child.dst_path is not None else "NONE"))
+                results.append(ok)
+        self.logger.info("End: split study")
+
+        if not all(results):
+            self.close("Error : split study failure. (" + str(results.count(False)) + " of " + str(len(results)) +
+                       " studies) Results are in " + self.work_base_path.subject_d)
+        # 分割前のログは各 subject のログにコピー済み
+        self.logger = bcil_dcm_convert_logger.disposal_logger(self.logger)
+        os.remove(self.work_path.log_txt)
+        self.rm_work_files()
+        return True
 
-            self.logger.info("############## END BCIL_DCM_CONVERT ##############")
+    def get_split_folder_names(self, study_uids: List[str]) -> List[str]:
+        # study 毎の保存先の名前 (同じ名前になる study には _1, _2, ... を付ける)
+        names = [self.get_folder_name(self.get_naming_rule(self.study_last_files[study_uid]))
+                 for study_uid in study_uids]
+        duplicates = set([name for name in names if names.count(name) > 1])
+        counts = {}
+        for i, name in enumerate(names):
+            if name in duplicates:
+                counts[name] = counts.get(name, 0) + 1
+                names[i] = name + "_" + str(counts[name])
+        return names
+
+    def set_split_study(self, parent, study_uid: str):
+        # parent の読み込み結果のうち study_uid の分を設定する
+        self.split_files = True
+        with open(parent.work_path.log_txt, "r") as src_file, open(self.work_path.log_txt, "a") as dst_file:
+            dst_file.write(src_file.read())
+        self.logger.info("Split study: " + study_uid + " (from " + parent.work_base_path.bdc_id + ")")
+
+        self.study.df = parent.study.df[parent.study.df["StudyUID"] == study_uid].reset_index(drop=True)
+        self.series.df = parent.series.df[parent.series.df["Study UID"] == study_uid].reset_index(drop=True)
+        self.dcm.df = parent.dcm.df[parent.dcm.df["Series UID"].isin(self.series.df["Series UID"])]
+        self.dcm.df = self.dcm.df.reset_index(drop=True)
+        if self.compact_dcm_list is True:
+            self.dcm.save_compact(self.work_path.dcm_compact, self.dcm.df)
+        else:
+            self.dcm.save_csv(self.work_path.dcm_csv, self.dcm.df)
+        self.add_dcm_file_count()
 
+    def convert_split_child(self, src_folders: List) -> bool:
+        # split_study の 1 study 分 (thread 内で実行される。close() による exit も失敗として返す)
+        try:
+            self.convert_subject(src_folders, {})
+            return True
+        except SystemExit:
+            return False
+        except Exception as e:
+            self.logger.critical("Error : " + str(e))
+            return False
         finally:
             if self.console_logger is not None:
                 self.console_logger = bcil_dcm_convert_logger.disposal_logger(self.console_logger)
             if self.logger is not None:
                 self.logger = bcil_dcm_convert_logger.disposal_logger(self.logger)
 
-        return True
-
     def check_src_dcm(self) -> List:
         # src dcm path check
         tmp = []
@@ -252,6 +440,9 @@ class BcilDcmConvert:
         src_list = []
         for src in tmp:
             if zipfile.is_zipfile(src):  # zip file
+                if self.zip_native is True:  # 展開せずに zip 内の DICOM を直接読み込む
+                    src_list.append(src)
+                    continue
                 zn = os.path.splitext(os.path.basename(src))[0]
                 unzip_path = self.get_unique_path_inc(self.work_base_path.unzip_d, zn) + os.sep
                 self.mkdir(unzip_path)
@@ -261,171 +452,260 @@ class BcilDcmConvert:
         return src_list
 
     def unzip_exec(self, src_path: str, unzip_path: str) -> str:
+        # DICOM のメンバーのみを並列に展開し、展開したファイル一覧を保持する
         self.logger.info("Start : unzip ")
         self.logger.info(" " + src_path + " > " + unzip_path + "")
         try:
             with zipfile.ZipFile(src_path, "r") as zf:
-                for file in tqdm.tqdm(desc="unzipping input DICOM.zip",
-                                      leave=True, ascii=True, iterable=zf.namelist(), total=len(zf.namelist())):
-                    zf.extract(member=file, path=unzip_path)
-                self.logger.info("End: unzip (" + str(len(zf.namelist())) + " files.)")
+                file_infos = [info for info in zf.infolist() if not info.is_dir()]
+                infos = [info for info in file_infos if self.is_dcm_member(zf, info.filename)]
+            skip_count = len(file_infos) - len(infos)
+            total_size = sum([info.file_size for info in infos])
+
+            chunk_size = max(1, -(-len(infos) // (self.jobs * 4)))
+            chunks = [[info.filename for info in infos[i:i + chunk_size]] for i in range(0, len(infos), chunk_size)]
+            results = [[] for _ in chunks]
+            start = time.time()
+            with tqdm.tqdm(desc="unzipping input DICOM.zip", total=len(infos), leave=True, ascii=True) as pbar:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    futures = dict([(executor.submit(self.unzip_members, src_path, chunk, unzip_path), i)
+                                    for i, chunk in enumerate(chunks)])
+                    for future in concurrent.futures.as_completed(futures):
+                        results[futures[future]] = future.result()
+                        pbar.update(len(results[futures[future]]))
+            elapsed = max(time.time() - start, 1e-6)
+
+            # 展開後に os.walk で列挙していた時と同じ順序にする
+            self.src_file_lists[unzip_path] = self.sort_as_walk(
+                unzip_path, [f for chunk_files in results for f in chunk_files])
+            self.logger.info("End: unzip (" + str(len(infos)) + " files. " + str(skip_count) + " files skipped. " +
+                             "{:.1f} MB/s".format(total_size / 1024 / 1024 / elapsed) + ")")
             return unzip_path
         except Exception as e:
             self.close("Error : " + src_path + " > " + unzip_path + " failure. " + str(e))
 
-    def create_dcm_list(self, src_list: List) -> int:
+    @classmethod
+    def sort_as_walk(cls, top: str, files: List[str]) -> List[str]:
+        # top 以下のファイルを os.walk と同じ順序に並べる
+        # (ファイルはディレクトリ毎に名前順、ディレクトリは os.scandir の順)
+        dir_files = {}
+        for f in files:
+            dir_files.setdefault(os.path.dirname(os.path.normpath(f)), []).append(f)
+        sorted_files = []
+        stack = [os.path.normpath(top)]
+        while len(stack) > 0:
+            d = stack.pop()
+            sorted_files.extend(sorted(dir_files.get(d, []), key=os.path.basename))
+            stack.extend(reversed(cls.scandir_entries(d)[1]))
+        return sorted_files
+
+    @staticmethod
+    def unzip_members(src_path: str, members: List[str], unzip_path: str) -> List[str]:
+        # スレッド毎に ZipFile を開く
+        with zipfile.ZipFile(src_path, "r") as zf:
+            return [zf.extract(member=member, path=unzip_path) for member in members]
+
+    def create_dcm_list(self, src_list: List) -> List[str]:
 
         self.logger.info("Start: get_dcm_list")
-        count = 0
-        with open(self.work_path.dcm_list, mode='w', encoding="utf-8") as out_f:
-            for src in src_list:
-                for folder in [src]:
-                    for root, dirs, files in os.walk(top=folder):
-                        s_files = sorted(files)
-                        for file in s_files:
-                            if file.endswith((".ima", ".dcm", ".dic", ".dc3", ".dicom", ".IMA", ".DCM", ".DIC", ".DC3", ".DICOM")) \
-                                    or (file.isalnum() and len(file) == 8):  # 指定拡張子or拡張子なし8文字の英数ファイル名
-                                file_full_path = os.path.join(root, file)
-                                out_f.write(file_full_path + '\n')
-                                count += 1
-        self.logger.info("End: get_dcm_list (" + str(count) + " files.)")
-        if count == 0:
+        dcm_files = []
+        for src in src_list:
+            if src in self.src_file_lists:  # unzip_exec で展開済み
+                dcm_files.extend(self.src_file_lists[src])
+            elif os.path.isfile(src):  # zip (zip_native)
+                dcm_files.extend(self.get_zip_dcm_list(src))
+            else:
+                dcm_files.extend(self.scan_dcm_dir(src))
+        self.logger.info("End: get_dcm_list (" + str(len(dcm_files)) + " files.)")
+        if len(dcm_files) == 0:
             self.close("dcm file not found.", 0)
-        return count
+        return dcm_files
+
+    def scan_dcm_dir(self, src: str) -> List[str]:
+        # トップレベルのサブディレクトリ毎に並列に走査する
+        # (順序は os.walk と同じ: ファイルはディレクトリ毎に名前順、ディレクトリは os.scandir の順)
+        files, dirs = self.scandir_entries(src)
+        dcm_files = [f for f in files if self.is_dcm_file(f)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for sub_dcm_files in executor.map(self.walk_dcm_dir, dirs):
+                dcm_files.extend(sub_dcm_files)
+        return dcm_files
+
+    def walk_dcm_dir(self, top: str) -> List[str]:
+        files, dirs = self.scandir_entries(top)
+        dcm_files = [f for f in files if self.is_dcm_file(f)]
+        for d in dirs:
+            dcm_files.extend(self.walk_dcm_dir(d))
+        return dcm_files
+
+    @staticmethod
+    def scandir_entries(top: str) -> tuple:
+        # (files, dirs) files は名前順、dirs は os.scandir の順 (os.walk と同じ)。シンボリックリンクのディレクトリは辿らない
+        files = []
+        dirs = []
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append((entry.name, entry.path))
+                    else:
+                        files.append((entry.name, entry.path))
+        except OSError:
+            return [], []
+        return [p for n, p in sorted(files)], [p for n, p in dirs]
+
+    def is_dcm_file(self, path: str) -> bool:
+        if self.dicm_check is not True:
+            return self.is_dcm_file_name(os.path.basename(path))
+        try:
+            with open(path, "rb") as fp:
+                return self.has_dicm_prefix(fp)
+        except OSError:
+            return False
 
-    def read_dcm_header(self, file_count: int) -> dict:
+    @staticmethod
+    def has_dicm_prefix(fp) -> bool:
+        # 128 byte の preamble に続く "DICM"
+        return fp.read(132)[128:132] == b"DICM"
+
+    @classmethod
+    def is_dcm_file_name(cls, file: str) -> bool:
+        # 指定拡張子or拡張子なし8文字の英数ファイル名
+        return file.endswith(cls.DCM_FILE_EXT) or (file.isalnum() and len(file) == 8)
+
+    def is_dcm_member(self, zf: zipfile.ZipFile, member: str) -> bool:
+        if self.dicm_check is not True:
+            return self.is_dcm_file_name(posixpath.basename(member))
+        with zf.open(member) as fp:
+            return self.has_dicm_prefix(fp)
+
+    def get_zip_dcm_list(self, src_path: str) -> List[str]:
+        # central directory から DICOM ファイルを列挙する (展開しないためディレクトリを含めて名前順)
+        try:
+            with zipfile.ZipFile(src_path, "r") as zf:
+                members = sorted([info.filename for info in zf.infolist()
+                                  if not info.is_dir() and self.is_dcm_member(zf, info.filename)])
+        except Exception as e:
+            self.close("Error : " + src_path + " read failure. " + str(e))
+        return [src_path + self.ZIP_MEMBER_SEP + member for member in members]
+
+    def get_disk_path(self, file: str) -> str:
+        # zip_native のファイルは extract_zip_members で展開したパス
+        zip_member = self.split_zip_member(file)
+        if zip_member is None:
+            return file
+        return os.path.join(self.zip_extract_dirs[zip_member[0]], *zip_member[1].split("/"))
+
+    def extract_zip_members(self, src_list: List) -> List:
+        # zip_native の zip 入力は DICOMlist のファイルのみ展開する (dcm2niix 用)
+        folder_list = []
+        for src in src_list:
+            if not os.path.isfile(src):
+                folder_list.append(src)
+                continue
+            prefix = src + self.ZIP_MEMBER_SEP
+            members = [f[len(prefix):] for f in self.dcm.df["File path"] if f.startswith(prefix)]
+            zn = os.path.splitext(os.path.basename(src))[0]
+            unzip_path = self.get_unique_path_inc(self.work_base_path.unzip_d, zn) + os.sep
+            self.mkdir(unzip_path)
+            self.logger.info("Start : unzip (DICOM only)")
+            self.logger.info(" " + src + " > " + unzip_path + "")
+            try:
+                zf = self.get_zip_handle(src)
+                for member in tqdm.tqdm(desc="unzipping DICOM for dcm2niix",
+                                        leave=True, ascii=True, iterable=members, total=len(members)):
+                    zf.extract(member=member, path=unzip_path)
+            except Exception as e:
+                self.close("Error : " + src + " > " + unzip_path + " failure. " + str(e))
+            self.logger.info("End: unzip (" + str(len(members)) + " files.)")
+            self.zip_extract_dirs[src] = unzip_path
+            folder_list.append(unzip_path)
+        return folder_list
+
+    @classmethod
+    def split_zip_member(cls, file: str) -> Optional[tuple]:
+        if cls.ZIP_MEMBER_SEP not in file:
+            return None
+        zip_path, member = file.split(cls.ZIP_MEMBER_SEP, 1)
+        if not os.path.isfile(zip_path):
+            return None
+        return zip_path, member
+
+    @classmethod
+    def get_zip_handle(cls, zip_path: str) -> zipfile.ZipFile:
+        # プロセス毎にハンドルを持つ (fork 後にファイル位置を共有しないため)
+        key = (os.getpid(), zip_path)
+        if key not in cls.zip_handles:
+            cls.zip_handles[key] = zipfile.ZipFile(zip_path, "r")
+        return cls.zip_handles[key]
+
+    @classmethod
+    def close_zip_handles(cls):
+        for key in [k for k in cls.zip_handles.keys() if k[0] == os.getpid()]:
+            cls.zip_handles.pop(key).close()
+
+    @classmethod
+    def read_dcm(cls, file: str, **kwargs) -> pydicom.dataset.FileDataset:
+        zip_member = cls.split_zip_member(file)
+        if zip_member is None:
+            return pydicom.read_file(file, **kwargs)
+        with cls.get_zip_handle(zip_member[0]).open(zip_member[1]) as fp:
+            return pydicom.read_file(fp, **kwargs)
+
+    def copy_dcm(self, file: str, dst: str):
+        zip_member = self.split_zip_member(file)
+        if zip_member is None:
+            shutil.copy(file, dst)
+            return
+        with self.get_zip_handle(zip_member[0]).open(zip_member[1]) as src_f, open(dst, "wb") as dst_f:
+            shutil.copyfileobj(src_f, dst_f)
+
+    def read_dcm_header(self, files: List[str]) -> dict:
 
         self.logger.info("Start: read_dcm_header")
         read_count: int = 0
 
-        # dcm csv setting
-        dcm_csv = open(self.work_path.dcm_csv, mode='w', encoding="utf-8")
-        dcm_csv_format = '{},{},{},{}\n'
-        dcm_csv.write(dcm_csv_format.format("Series Number", "Instance Number", "File path", "Series UID"))  # header
+        # dcm list setting
+        self.dcm.spill_dir = self.work_path.subject_d
+        if self.dcm_list_memory is not None:
+            self.dcm.memory_limit = self.dcm_list_memory * 1024 * 1024
 
-        with open(self.work_path.dcm_list, mode='r', encoding="utf-8")as r:
-            for line in tqdm.tqdm(r, desc="reading DICOM", total=file_count, leave=True, ascii=True):
+        last_read_file = None
+        for file, status, series_number, instance_num, series_uid, study_uid in self.scan_dcm_headers(files):
+            read_count += 1
 
-                file = line.rstrip('\r\n')
-                read_count += 1
+            if status == "invalid":
+                self.logger.warning("Warning : skip file (can not read) : " + file)
+                continue
+            last_read_file = file
+            if status == "no_image":
+                self.logger.warning("Warning : skip file (no image) : " + file)
+                continue
 
-                try:
-                    ds = pydicom.read_file(file)
-                except InvalidDicomError:
-                    self.logger.warning("Warning : skip file (can not read) : " + file)
-                    continue
-                if 'PixelData' not in ds:
-                    self.logger.warning("Warning : skip file (no image) : " + file)
-                    continue
+            # dcm list
+            self.dcm.add_record(series_number, instance_num, file, series_uid)
+            if self.split_study is True:
+                self.study_last_files[study_uid] = file
 
-                series_number = ds["0x00200011"].value
-                series_uid = str(ds["0x0020000e"].value)
-                study_uid = str(ds["0x0020000d"].value)
-                instance_num = ds["0x00200013"].value
+            if self.series.has_unique(series_uid):  # series_uid が既出の場合は次へスキップ
+                continue
 
-                # dcm csv write
-                dcm_csv.write(dcm_csv_format.format(series_number, instance_num, file, series_uid))
+            rows = self.header_index.get_series(file) if self.header_index is not None else None
+            if rows is None:
+                rows = self.read_series_rows(file, series_number, series_uid, study_uid)
+                if self.header_index is not None:
+                    self.header_index.put_series(file, *rows)
+            series_row, study_row = rows
+            self.series.add_row_dict(series_row)
 
-                if series_uid in self.series.get_unique_col():  # series_uid が既出の場合は次へスキップ
-                    continue
+            # study
+            if not self.study.has_unique(study_uid):
+                self.study.add_row_dict(study_row)
 
-                manufacturer = str(ds["0x00080070"].value) if "0x00080070" in ds else None
-                patient_position = str(ds["0x00185100"].value) if "0x00185100" in ds else None
-
-                # kspace info
-                mri_identifier = gradient = system = dwelltime_read = dwelltime_phase = None
-                read_direction = phase_direction = slice_direction = fl_reference_amplitude = None
-                parallel_factor = multiband_factor = uc_flip_angle_mode = phase_partial_fourier = None
-                slice_partial_fourier = None
-
-                if 'SIEMENS' in manufacturer.upper():
-                    k = BcilDcmKspaceInfo(file)
-                    k.setup_file_logger(self.work_path.log_txt)
-                    k.main()
-                    (mri_identifier, gradient, system, dwelltime_read, dwelltime_phase,
-                     read_direction, phase_direction, slice_direction, fl_reference_amplitude,
-                     parallel_factor, multiband_factor, uc_flip_angle_mode, phase_partial_fourier,
-                     slice_partial_fourier) = k.output
-                    del k
-
-                # series
-                if mri_identifier == "extended":
-                    variable_data = self.get_variable_data_extended(ds)
-                    if uc_flip_angle_mode == "16":
-                        variable_data["FA"] = None
-                elif mri_identifier == "interoperatabillity":
-                    variable_data = self.get_variable_data_interoperatabillity(ds)
-                else:
-                    variable_data = self.get_variable_data(ds)
-
-                image_type = ds["0x00080008"].value if "0x00080008" in ds else []
-                if mri_identifier == "extended":
-                    image_type = variable_data['Image Type']
-
-                self.series.add_row_dict({
-                    "Series Number": series_number,
-                    "Time": ds["0x00080031"].value if "0x00080031" in ds else None,
-                    "Description": ds["0x0008103e"].value if "0x0008103e" in ds else None,
-                    "Protocol": ds["0x00181030"].value if "0x00181030" in ds else None,
-                    "Scanning Sequence": variable_data['Scanning_Sequence'],
-                    "Sequence Name": variable_data['Sequence_Name'],
-                    "TR[msec]": variable_data['TR'],
-                    "TE[msec]": variable_data['TE'],
-                    "TI[msec]": variable_data['TI'],
-                    "FA[degree]": variable_data['FA'],
-                    "Matrix(phase*read)": variable_data['Matrix'],
-                    "Pixel size[mm]": variable_data['Pixel_size'],
-                    "Slice thickness[mm]": variable_data['Slice_thickness'],
-                    "Number of averages": variable_data['Number_of_averages'],
-                    "Image Type": ' '.join(map(str, image_type)),
-                    "DwelltimeRead": dwelltime_read,
-                    "DwelltimePhase": dwelltime_phase,
-                    "Patient Position": patient_position,
-                    "Read.direction": read_direction,
-                    "Phase.direction": phase_direction,
-                    "Slice.direction": slice_direction,
-                    "flReferenceAmplitude": fl_reference_amplitude,
-                    "Parallel factor": parallel_factor,
-                    "Multi-band factor": multiband_factor,
-                    "PhasePartialFourier": phase_partial_fourier,
-                    "SlicePartialFourier": slice_partial_fourier,
-                    "Total Count of DICOMs": 0,
-                    "Example DICOM": file,
-                    "Series UID": series_uid,
-                    "Study UID": study_uid,
-                    "NIFTI in RawData": None,
-                    "NIFTI in BIDS": None,
-                })
-
-                # study
-                study_uid_list = self.study.get_unique_col()
-                if study_uid not in study_uid_list:
-                    self.study.add_row_dict({
-                        "Patient Name": ds["0x00100010"].value if "0x00100010" in ds else None,
-                        "Patient ID": ds["0x00100020"].value if "0x00100020" in ds else None,
-                        "Patient's Birth date": ds["0x00100030"].value if "0x00100030" in ds else None,
-                        "Patient's Sex": ds["0x00100040"].value if "0x00100040" in ds else None,
-                        "Patient's Age": ds["0x00101010"].value if "0x00101010" in ds else None,
-                        "Patient's Size": ds["0x00101020"].value if "0x00101020" in ds else None,
-                        "Patient's Weight": ds["0x00101030"].value if "0x00101030" in ds else None,
-                        "Patient's Position": patient_position,
-                        "Study Date": ds["0x00080020"].value if "0x00080020" in ds else None,
-                        "Study Description": ds["0x00081030"].value if "0x00081030" in ds else None,
-                        "Requesting physician": ds["0x00321032"].value if "0x00321032" in ds else None,
-                        "Station": str(ds["0x00081010"].value) if "0x00081010" in ds else None,
-                        "Manufacturer": manufacturer,
-                        "Model": ds["0x00081090"].value if "0x00081090" in ds else None,
-                        "Institution": ds["0x00080080"].value if "0x00080080" in ds else None,
-                        "System": system,
-                        "Gradient": gradient,
-                        "StudyUID": study_uid,
-                        "PatAUSJID": ds["0xC0D30011"].value if "0xC0D30011" in ds else None,
-                    })
-
-        dcm_csv.close()
-
-        # study UID unique check
-        self.unique_study_check(study_uid_list)
+        # study UID unique check (split_study の場合は study 毎に分けて変換する)
+        if self.split_study is False:
+            self.unique_study_check(self.study.get_unique_values())
 
         # conv df
         self.study.df = self.study.from_dict()
@@ -433,15 +713,23 @@ class BcilDcmConvert:
         self.series.df = self.series.from_dict()
         self.series.df = self.series.df.sort_values(["Series Number", "TE[msec]"]).reset_index(drop=True)
 
-        self.dcm.df = self.dcm.read_csv(self.work_path.dcm_csv).astype(self.dcm.d_type)
-        self.dcm.df = self.dcm.df.sort_values(["Series Number", "Instance Number"]).reset_index(drop=True)
-        self.dcm.save_csv(self.work_path.dcm_csv, self.dcm.df)  # 保存
+        compact_path = self.work_path.dcm_compact if self.compact_dcm_list is True else None
+        self.dcm.df = self.dcm.records_to_df(self.work_path.dcm_csv, compact_path)  # sort & 保存
 
-        self.add_dcm_file_count()
+        if self.split_study is False or len(self.study.df) <= 1:  # 複数 study の場合は分割後に確認する
+            self.add_dcm_file_count()
 
         # naming_rule_list 最後の一枚から情報取得
+        naming_rule_list = self.get_naming_rule(last_read_file)
+
+        self.logger.info(
+            "End: read_dcm_header (" + str(len(self.series.df)) + " series. " + str(read_count) + " files.)")
+        return naming_rule_list
+
+    def get_naming_rule(self, file: str) -> dict:
         naming_rule_list = {}
         if self.subject_name is not None and len(self.subject_name) > 0 and "%" in self.subject_name:
+            ds = self.read_dcm_header_only(file)
             naming_rule_list = {
                 r"%a": self.esc(str(ds["0x0051100f"].value)) if "0x0051100f" in ds else "",
                 r"%i": self.esc(str(ds["0x00100020"].value)) if "0x00100020" in ds else "",
@@ -450,11 +738,158 @@ class BcilDcmConvert:
                 r"%n": self.esc(str(ds["0x00100010"].value)) if "0x00100010" in ds else "",
                 r"%x": self.esc(str(ds["0x00200010"].value)) if "0x00200010" in ds else "",
             }
-
-        self.logger.info(
-            "End: read_dcm_header (" + str(len(self.series.df)) + " series. " + str(read_count) + " files.)")
         return naming_rule_list
 
+    def read_series_rows(self, file: str, series_number: int, series_uid: str, study_uid: str) -> tuple:
+        # series 代表ファイルのみ全ヘッダを読み込む
+        ds = self.read_dcm(file, stop_before_pixels=True)
+
+        manufacturer = str(ds["0x00080070"].value) if "0x00080070" in ds else None
+        patient_position = str(ds["0x00185100"].value) if "0x00185100" in ds else None
+
+        # kspace info
+        mri_identifier = gradient = system = dwelltime_read = dwelltime_phase = None
+        read_direction = phase_direction = slice_direction = fl_reference_amplitude = None
+        parallel_factor = multiband_factor = uc_flip_angle_mode = phase_partial_fourier = None
+        slice_partial_fourier = None
+
+        if 'SIEMENS' in manufacturer.upper():
+            k = BcilDcmKspaceInfo(file, ds)
+            k.setup_file_logger(self.work_path.log_txt)
+            k.main()
+            (mri_identifier, gradient, system, dwelltime_read, dwelltime_phase,
+             read_direction, phase_direction, slice_direction, fl_reference_amplitude,
+             parallel_factor, multiband_factor, uc_flip_angle_mode, phase_partial_fourier,
+             slice_partial_fourier) = k.output
+            del k
+
+        # series
+        if mri_identifier == "extended":
+            variable_data = self.get_variable_data_extended(ds)
+            if uc_flip_angle_mode == "16":
+                variable_data["FA"] = None
+        elif mri_identifier == "interoperatabillity":
+            variable_data = self.get_variable_data_interoperatabillity(ds)
+        else:
+            variable_data = self.get_variable_data(ds)
+
+        image_type = ds["0x00080008"].value if "0x00080008" in ds else []
+        if mri_identifier == "extended":
+            image_type = variable_data['Image Type']
+
+        series_row = {
+            "Series Number": series_number,
+            "Time": ds["0x00080031"].value if "0x00080031" in ds else None,
+            "Description": ds["0x0008103e"].value if "0x0008103e" in ds else None,
+            "Protocol": ds["0x00181030"].value if "0x00181030" in ds else None,
+            "Scanning Sequence": variable_data['Scanning_Sequence'],
+            "Sequence Name": variable_data['Sequence_Name'],
+            "TR[msec]": variable_data['TR'],
+            "TE[msec]": variable_data['TE'],
+            "TI[msec]": variable_data['TI'],
+            "FA[degree]": variable_data['FA'],
+            "Matrix(phase*read)": variable_data['Matrix'],
+            "Pixel size[mm]": variable_data['Pixel_size'],
+            "Slice thickness[mm]": variable_data['Slice_thickness'],
+            "Number of averages": variable_data['Number_of_averages'],
+            "Image Type": ' '.join(map(str, image_type)),
+            "DwelltimeRead": dwelltime_read,
+            "DwelltimePhase": dwelltime_phase,
+            "Patient Position": patient_position,
+            "Read.direction": read_direction,
+            "Phase.direction": phase_direction,
+            "Slice.direction": slice_direction,
+            "flReferenceAmplitude": fl_reference_amplitude,
+            "Parallel factor": parallel_factor,
+            "Multi-band factor": multiband_factor,
+            "PhasePartialFourier": phase_partial_fourier,
+            "SlicePartialFourier": slice_partial_fourier,
+            "Total Count of DICOMs": 0,
+            "Example DICOM": file,
+            "Series UID": series_uid,
+            "Study UID": study_uid,
+            "NIFTI in RawData": None,
+            "NIFTI in BIDS": None,
+        }
+
+        # study
+        study_row = {
+                "Patient Name": ds["0x00100010"].value if "0x00100010" in ds else None,
+                "Patient ID": ds["0x00100020"].value if "0x00100020" in ds else None,
+                "Patient's Birth date": ds["0x00100030"].value if "0x00100030" in ds else None,
+                "Patient's Sex": ds["0x00100040"].value if "0x00100040" in ds else None,
+                "Patient's Age": ds["0x00101010"].value if "0x00101010" in ds else None,
+                "Patient's Size": ds["0x00101020"].value if "0x00101020" in ds else None,
+                "Patient's Weight": ds["0x00101030"].value if "0x00101030" in ds else None,
+                "Patient's Position": patient_position,
+                "Study Date": ds["0x00080020"].value if "0x00080020" in ds else None,
+                "Study Description": ds["0x00081030"].value if "0x00081030" in ds else None,
+                "Requesting physician": ds["0x00321032"].value if "0x00321032" in ds else None,
+                "Station": str(ds["0x00081010"].value) if "0x00081010" in ds else None,
+                "Manufacturer": manufacturer,
+                "Model": ds["0x00081090"].value if "0x00081090" in ds else None,
+                "Institution": ds["0x00080080"].value if "0x00080080" in ds else None,
+                "System": system,
+                "Gradient": gradient,
+                "StudyUID": study_uid,
+                "PatAUSJID": ds["0xC0D30011"].value if "0xC0D30011" in ds else None,
+        }
+        return series_row, study_row
+
+    def scan_dcm_headers(self, files: List[str]) -> List[tuple]:
+        # (file, status, series number, instance number, series uid, study uid) を files の順に返す
+        if self.header_index is None:
+            return self.read_dcm_header_records(files)
+
+        # header index に登録済みで変更のないファイルは読み込まない
+        records = self.header_index.get_records(files)
+        read_files = [file for file, record in zip(files, records) if record is None]
+        self.logger.info("header index: " + str(len(files) - len(read_files)) + " files cached, " +
+                         str(len(read_files)) + " files to read (" + self.header_index.path + ")")
+        read_records = self.read_dcm_header_records(read_files)
+        self.header_index.put_records(read_records)
+        read_records_iter = iter(read_records)
+        return [next(read_records_iter) if record is None else record for record in records]
+
+    def read_dcm_header_records(self, files: List[str]) -> List[tuple]:
+        records = []
+        with tqdm.tqdm(desc="reading DICOM", total=len(files), leave=True, ascii=True) as pbar:
+            if self.jobs == 1 or len(files) < 2:
+                for file in files:
+                    records.append(self.read_dcm_header_record(file))
+                    pbar.update(1)
+                return records
+
+            # 連続したチャンクに分割し、チャンク順に結合する (series 初出ファイルの判定を直列実行と一致させる)
+            chunk_size = max(1, -(-len(files) // (self.jobs * 4)))
+            chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+            self.logger.info("read_dcm_header: " + str(self.jobs) + " processes, " + str(len(chunks)) + " chunks")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                for chunk_records in executor.map(self.scan_dcm_header_chunk, chunks):
+                    records.extend(chunk_records)
+                    pbar.update(len(chunk_records))
+        return records
+
+    @classmethod
+    def scan_dcm_header_chunk(cls, files: List[str]) -> List[tuple]:
+        return [cls.read_dcm_header_record(file) for file in files]
+
+    @classmethod
+    def read_dcm_header_record(cls, file: str) -> tuple:
+        try:
+            ds = cls.read_dcm_header_only(file)
+        except InvalidDicomError:
+            return file, "invalid", None, None, None, None
+        if 'PixelData' not in ds:
+            return file, "no_image", None, None, None, None
+        return (file, "ok", ds["0x00200011"].value, ds["0x00200013"].value,
+                str(ds["0x0020000e"].value), str(ds["0x0020000d"].value))
+
+    @classmethod
+    def read_dcm_header_only(cls, file: str) -> pydicom.dataset.FileDataset:
+        # PixelData は要素ヘッダのみ読み込み、値は読み込まない (defer)
+        return cls.read_dcm(file, specific_tags=cls.DCM_HEADER_TAGS, defer_size=cls.DCM_HEADER_DEFER_SIZE)
+
     @staticmethod
     def get_variable_data(ds: pydicom.dataset) -> list:
         variable_data = {
@@ -590,39 +1025,30 @@ class BcilDcmConvert:
 
     def add_dcm_file_count(self) -> NoReturn:
 
-        last_data = {"series_number": None, "instance_numbers": []}
-        for index, item in self.series.df.iterrows():
-            dcm_row = self.dcm.df[
-                (self.dcm.df['Series Number'] == item['Series Number']) & (self.dcm.df['Series UID'] == item['Series UID'])]
-            # add count
-            self.series.df.at[index, 'Total Count of DICOMs'] = len(dcm_row)
-            # series numberが同じで series uidが異なるデータが存在する(QSM等)為 周回遅れで処理
-            if last_data["series_number"] is not None and last_data["series_number"] != item['Series Number']:
-                self.check_dcm_range(last_data)
-                last_data["instance_numbers"] = []
-            last_data["series_number"] = item['Series Number']
-            last_data["instance_numbers"].extend(list(dcm_row["Instance Number"]))
-        self.check_dcm_range(last_data)
+        keys = ["Series Number", "Series UID"]
+        dcm_row = self.dcm.df[keys + ["Instance Number"]].merge(self.series.df[keys], on=keys, how="inner")
+        # add count
+        count = dcm_row.groupby(keys).size().rename("count").reset_index()
+        count = self.series.df[keys].merge(count, on=keys, how="left")["count"]
+        self.series.df['Total Count of DICOMs'] = count.fillna(0).astype(int).to_numpy()
+        # series numberが同じで series uidが異なるデータが存在する(QSM等)為 series number 毎に確認
+        for series_number, instance_numbers in dcm_row.groupby("Series Number", sort=True)["Instance Number"]:
+            self.check_dcm_range(series_number, instance_numbers.to_numpy())
         return True
 
-    def check_dcm_range(self, data: dict) -> NoReturn:
-        series_number = data["series_number"]
-        instance_num_list = data["instance_numbers"]
-        instance_num_list.sort()
+    def check_dcm_range(self, series_number: int, instance_numbers: np.ndarray) -> NoReturn:
+        instance_num_list, counts = np.unique(instance_numbers, return_counts=True)  # sorted
         # first number check
         if instance_num_list[0] != 1:
             self.warn("series number: " + str(series_number) + ", start instance number: " + str(instance_num_list[0]))
         # duplication check
-        dup = [k for k, v in Counter(instance_num_list).items() if v > 1]
+        dup = instance_num_list[counts > 1]
         if len(dup) > 0:
             m = "series number: " + str(series_number) + ", instance number: " + ', '.join(map(str, dup))
             self.warn("Error: duplicate instance number. (" + m + ".)")
-            instance_num_list = list(set(instance_num_list))  # 重複削除
         # missing check
-        missing = []
-        for i in range(instance_num_list[0], instance_num_list[-1] + 1):
-            if i not in instance_num_list:
-                missing.append(i)
+        missing = np.setdiff1d(
+            np.arange(instance_num_list[0], instance_num_list[-1] + 1), instance_num_list, assume_unique=True)
         if len(missing) > 0:
             m = "series number: " + str(series_number) + ", instance number: " + ', '.join(map(str, missing))
             self.warn("Error: missing instance number. (" + m + ".)")
@@ -632,7 +1058,7 @@ class BcilDcmConvert:
         for index, item in self.series.df.iterrows():
             save_file_path = self.get_unique_path_inc(self.work_path.dicom_d, str(item['Series Number']), ".dcm")
             try:
-                shutil.copy(item['Example DICOM'], save_file_path)
+                self.copy_dcm(item['Example DICOM'], save_file_path)
             except Exception as e:
                 self.warn("Error : save_example_dicom: " + str(e))
                 continue
@@ -642,50 +1068,39 @@ class BcilDcmConvert:
         self.logger.info("Start: dcm2niix")
         self.mkdir(self.work_path.nifti_d)
 
-        # multi dcm src folder
-        nifti_src_folder_path = src_folders[0]
-        if len(src_folders) > 1:  # linkで対応
-            self.mkdir(self.work_base_path.link_d)
-            for src_folder in src_folders:
-                dir_name = os.path.basename(os.path.dirname(src_folder))
-                os.symlink(src_folder, self.get_unique_path_inc(self.work_base_path.link_d, dir_name))
-            nifti_src_folder_path = self.work_base_path.link_d
-
-        with tqdm.tqdm(desc="converting DICOM to NIFTI", total=100, leave=True, ascii=True) as nip:
-            nip.update(1)
-            cmd_ary = [
-                self.DCM_2_NIIX_CMD,  # dcm2niix
-                "-f", self.DCM_2_NAMING_RULE,  # filename
-                "-w", "1" if (self.overwrite != 0) else "0",  # write behavior for name conflicts
-                "-o", self.work_path.nifti_d  # output directory
-            ]
-            if self.gz is True:
-                cmd_ary.extend(["-z", "y"])  # gz compress images
-            cmd_ary.append(nifti_src_folder_path)  # <in_folder> src
-
-            info_ary = []
-            error_ary = []
-            try:
-                ret = subprocess.run(cmd_ary, capture_output=True, text=True, check=True)
-                info_ary = list(filter(None, ret.stdout.split("\n")))
-                error_ary = list(filter(None, ret.stderr.split("\n")))
-
-            except subprocess.CalledProcessError as e:
-                info_ary = list(filter(None, e.stdout.split("\n")))
-                error_ary = list(filter(None, e.stderr.split("\n")))
-            except Exception as e:
-                self.logger.error("Error: dcm2niix: " + str(e))
-            finally:
+        if self.series_nifti is True:
+            self.save_nifti_series()
+        else:
+            # multi dcm src folder
+            nifti_src_folder_path = src_folders[0]
+            if self.split_files is True:  # 分割した study のファイルのみリンクする
+                self.mkdir(self.work_base_path.link_d)
+                for i, file in enumerate(self.dcm.df["File path"]):
+                    os.symlink(self.get_disk_path(file),
+                               os.path.join(self.work_base_path.link_d, "{:06d}_{}".format(i, os.path.basename(file))))
+                nifti_src_folder_path = self.work_base_path.link_d
+            elif len(src_folders) > 1:  # linkで対応
+                self.mkdir(self.work_base_path.link_d)
+                for src_folder in src_folders:
+                    dir_name = os.path.basename(os.path.dirname(src_folder))
+                    os.symlink(src_folder, self.get_unique_path_inc(self.work_base_path.link_d, dir_name))
+                nifti_src_folder_path = self.work_base_path.link_d
+
+            with tqdm.tqdm(desc="converting DICOM to NIFTI", total=100, leave=True, ascii=True) as nip:
+                nip.update(1)
+                info_ary, error_ary, exception = self.run_dcm2niix(nifti_src_folder_path)
                 nip.update(99)
 
-            for message in info_ary:
-                self.logger.info(message)
-            for message in error_ary:
-                self.logger.error(message)
-                self.console_logger.error("dcm2niix: " + message)
+                if exception is not None:
+                    self.logger.error("Error: dcm2niix: " + exception)
+                for message in info_ary:
+                    self.logger.info(message)
+                for message in error_ary:
+                    self.logger.error(message)
+                    self.console_logger.error("dcm2niix: " + message)
 
-        if len(src_folders) > 1:  # 複数srcの場合はリンク対応を削除する
-            shutil.rmtree(nifti_src_folder_path)
+            if len(src_folders) > 1 or self.split_files is True:  # 複数srcの場合はリンク対応を削除する
+                shutil.rmtree(nifti_src_folder_path)
         self.logger.info("End: dcm2niix")
 
         # series 更新
@@ -702,6 +1117,68 @@ class BcilDcmConvert:
             search = self.series.df.loc[(self.series.df['Series Number'] == int(num))]
             self.series.df.at[search.index[0], 'NIFTI in RawData'] = ' '.join(file_list)
 
+    def save_nifti_series(self):
+        # series number 毎に DICOM のリンクを作成し、dcm2niix を並列に実行する
+        self.mkdir(self.work_base_path.link_d)
+        series_src = {}
+        for series_number, files in self.dcm.df.groupby("Series Number", sort=True)["File path"]:
+            link_dir = os.path.join(self.work_base_path.link_d, str(series_number))
+            self.mkdir(link_dir)
+            for i, file in enumerate(files):
+                os.symlink(self.get_disk_path(file), os.path.join(link_dir, "{:06d}_{}".format(i, os.path.basename(file))))
+            series_src[series_number] = link_dir
+
+        results = {}
+        with tqdm.tqdm(desc="converting DICOM to NIFTI", total=len(series_src), leave=True, ascii=True) as nip:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = dict([(executor.submit(self.run_dcm2niix, src), series_number)
+                                for series_number, src in series_src.items()])
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+                    nip.update(1)
+
+        for series_number in sorted(results.keys()):
+            info_ary, error_ary, exception = results[series_number]
+            prefix = "series number: " + str(series_number) + ", "
+            if exception is not None:
+                self.logger.error("Error: dcm2niix: " + prefix + exception)
+                self.console_logger.error("dcm2niix: " + prefix + exception)
+            for message in info_ary:
+                self.logger.info(prefix + message)
+            for message in error_ary:
+                self.logger.error(prefix + message)
+                self.console_logger.error("dcm2niix: " + prefix + message)
+        shutil.rmtree(self.work_base_path.link_d)
+
+    def run_dcm2niix(self, src_path: str) -> tuple:
+        # (stdout lines, stderr lines, exception message)
+        cmd_ary = [
+            self.DCM_2_NIIX_CMD,  # dcm2niix
+            "-f", self.DCM_2_NAMING_RULE,  # filename
+            "-w", "1" if (self.overwrite != 0) else "0",  # write behavior for name conflicts
+            "-o", self.work_path.nifti_d  # output directory
+        ]
+        if self.gz is True:
+            cmd_ary.extend(["-z", "y"])  # gz compress images
+        cmd_ary.append(src_path)  # <in_folder> src
+
+        info_ary = []
+        error_ary = []
+        exception = None
+        try:
+            ret = subprocess.run(cmd_ary, capture_output=True, text=True, check=True)
+            info_ary = list(filter(None, ret.stdout.split("\n")))
+            error_ary = list(filter(None, ret.stderr.split("\n")))
+
+        except subprocess.CalledProcessError as e:
+            info_ary = list(filter(None, e.stdout.split("\n")))
+            error_ary = list(filter(None, e.stderr.split("\n")))
+            if self.series_nifti is True:
+                exception = "exit status " + str(e.returncode)
+        except Exception as e:
+            exception = str(e)
+        return info_ary, error_ary, exception
+
     @staticmethod
     def permission_modify(dir_path) -> bool:
         dir_path += "" if dir_path.endswith(os.sep) else os.sep
@@ -731,7 +1208,18 @@ class BcilDcmConvert:
                                              '&': replace, '$': replace, '(': replace, ')': replace, }))
 
     def set_dist_path(self, naming_rule: dict) -> tuple:
-        
+
+        folder_name = self.get_folder_name(naming_rule)
+        dst_d = os.path.join(self.parent_d, folder_name)
+        if self.overwrite == 0 and os.path.exists(dst_d):
+            # 上書き禁止で既に同じディレクトリがある場合は別名を発行して保存
+            dst_d = self.get_unique_path_inc(self.parent_d, folder_name)
+            m = "Warning: Do not overwrite is selected, but the file already exists. Save to another location: " + dst_d
+            self.warn(m)
+        return self.gen_bdc_path(dst_d)
+
+    def get_folder_name(self, naming_rule: dict) -> str:
+
         if self.subject_name is not None and len(self.subject_name) > 0:
             tmp = self.subject_name
             if "%" in self.subject_name:
@@ -745,14 +1233,218 @@ class BcilDcmConvert:
             else:
                 name_base = self.dcm_dir_list[0] + ("" if self.dcm_dir_list[0].endswith(os.sep) else os.sep)
                 folder_name = os.path.basename(os.path.dirname(name_base))
-        
-        dst_d = os.path.join(self.parent_d, folder_name)
-        if self.overwrite == 0 and os.path.exists(dst_d):
-            # 上書き禁止で既に同じディレクトリがある場合は別名を発行して保存
-            dst_d = self.get_unique_path_inc(self.parent_d, folder_name)
-            m = "Warning: Do not overwrite is selected, but the file already exists. Save to another location: " + dst_d
-            self.warn(m)
-        return self.gen_bdc_path(dst_d)
+        return folder_name
+
+    @staticmethod
+    def get_sort_keys(df: pd.DataFrame, sort_cols: List[str]) -> List[list]:
+        # NaN は sort_values と同じく最後になるよう inf とする
+        return [[float("inf") if v != v else v for v in row]
+                for row in df[sort_cols].astype(float).itertuples(index=False, name=None)]
+
+    @staticmethod
+    def get_keys(df: pd.DataFrame, key_cols: List[str]) -> List[tuple]:
+        return [tuple([v.item() if hasattr(v, "item") else v for v in row])
+                for row in df[key_cols].astype(object).itertuples(index=False, name=None)]
+
+    def append_csv_rows(self, data: BaseCsvData, path: str, df: pd.DataFrame, append_index: DcmAppendIndex,
+                        key_cols: List[str], sort_cols: List[str]):
+        # 保存先にないキーの行のみを追記する。保存先の最後の行より前に入る場合のみ読み込んで sort し直す
+        name = os.path.basename(path)
+        size = append_index.file_size(name)
+        if not append_index.is_valid(name, path) and size is not None:
+            # 前回の追記が中断された場合 (途切れた末尾の行) は取り除く
+            cut = data.repair_csv(path, size)
+            if cut is not None:
+                self.warn("Warning: removed a truncated row at the end of " + name + " (" + str(cut) + " bytes).")
+                if cut == size:
+                    append_index.update_stat(name, path)
+        if not append_index.is_valid(name, path):
+            self.logger.info("Rebuilding: append index of " + name)
+            dst_df = data.read_csv(path).astype(data.d_type)
+            sort_keys = self.get_sort_keys(dst_df, sort_cols)
+            last_key = sort_keys[-1] if len(sort_keys) > 0 else None
+            if sort_keys != sorted(sort_keys):  # sort されていない場合は次回の追記で sort する
+                last_key = [float("inf")] * len(sort_cols)
+            append_index.rebuild(name, path, self.get_keys(dst_df, key_cols), last_key)
+
+        new_df = df.drop_duplicates(subset=key_cols)
+        new_df = new_df[append_index.new_key_mask(name, self.get_keys(new_df, key_cols))]
+        if len(new_df) == 0:
+            self.logger.info(name + ": no new rows.")
+            return
+
+        # df は sort_cols で sort 済み
+        sort_keys = self.get_sort_keys(new_df, sort_cols)
+        last_key = append_index.last_key(name)
+        if last_key is None or sort_keys[0] >= last_key:
+            data.append_csv(path, new_df)
+            self.logger.info(name + ": " + str(len(new_df)) + " rows appended.")
+        else:
+            dst_df = data.read_csv(path).astype(data.d_type)
+            merge_df = pd.concat([dst_df, new_df]).sort_values(sort_cols).reset_index(drop=True)
+            data.save_csv(path, merge_df)
+            sort_keys = self.get_sort_keys(merge_df, sort_cols)
+            self.logger.info(name + ": " + str(len(new_df)) + " rows merged and sorted.")
+        append_index.add(name, path, self.get_keys(new_df, key_cols), sort_keys[-1])
+
+    def check_bids_criteria(self):
+        # dcm2bids config の criteria と series の照合 (一致しない・複数一致する series を報告する)
+        self.logger.info("Start: check BIDS criteria (" + self.bids_config + ")")
+        try:
+            result = DcmCriteriaMatcher.from_config(self.bids_config).match_series(self.series.df)
+        except (OSError, ValueError) as e:
+            self.warn("Warning: check BIDS criteria failure. " + str(e))
+            return
+        for _, row in result.iterrows():
+            self.logger.info(" {}: {} {} > {}{}".format(
+                row["Status"], row["Series Number"], row["Description"], row["BIDS"] if row["BIDS"] != "" else "NONE",
+                " (unverified: " + row["Unverified"] + ")" if row["Unverified"] != "" else ""))
+        ambiguous = result[result["Status"] == "ambiguous"]
+        if len(ambiguous) > 0:
+            self.warn("Warning: series matched by multiple BIDS descriptions. (Series Number: " +
+                      ", ".join(map(str, ambiguous["Series Number"])) + ")")
+        self.logger.info("End: check BIDS criteria (matched: {}, ambiguous: {}, unmatched: {})".format(
+            (result["Status"] == "matched").sum(), len(ambiguous), (result["Status"] == "unmatched").sum()))
+
+    def update_catalog(self):
+        # 保存先の csv (append の場合は merge 後) を catalog に反映する
+        self.logger.info("Start: update catalog")
+        catalog = None
+        try:
+            catalog = DcmCatalog(self.parent_d)
+            catalog.update_subject_dir(self.dst_path.subject_d)
+        except Exception as e:
+            self.warn("Warning: update catalog failure. " + str(e))
+        finally:
+            if catalog is not None:
+                catalog.close()
+        self.logger.info("End: update catalog")
+
+    @staticmethod
+    def is_same_device(src: str, dst: str) -> bool:
+        try:
+            return os.stat(src).st_dev == os.stat(dst).st_dev
+        except OSError:
+            return False
+
+    def finalize_files(self, files: List[str], dirs: List[str]):
+        # work -> 保存先
+        # 保存先に無いフォルダは同じ file system であればフォルダ毎 rename し、
+        # それ以外はファイル毎に rename (同じ file system) または並列に copy して削除する
+        start = time.time()
+        # file system の判定は work と保存先の subject フォルダで 1 回のみ行う
+        self.mkdir(self.dst_path.subject_d)
+        same_device = self.is_same_device(self.work_path.subject_d, self.dst_path.subject_d)
+        renamed_dirs = []
+        files = list(files)
+        for src_d in dirs:
+            dst_d = src_d.replace(self.work_path.subject_d, self.dst_path.subject_d, 1)
+            if same_device and os.path.isdir(src_d) and len(os.listdir(src_d)) > 0 and not os.path.exists(dst_d):
+                try:
+                    os.rename(src_d, dst_d)
+                    renamed_dirs.append(dst_d)
+                    continue
+                except OSError:  # bind mount 等で rename できない場合はファイル毎に処理する
+                    pass
+            files.extend(glob.glob(src_d + "/*", recursive=False))
+
+        # 保存先のフォルダ作成と既存ファイルの確認はフォルダ毎に 1 回
+        moves = [(file, file.replace(self.work_path.subject_d, self.dst_path.subject_d, 1)) for file in files]
+        existing = {}
+        for dst_d in sorted(set([os.path.dirname(dst) for src, dst in moves])):
+            self.mkdir(dst_d)
+            existing[dst_d] = set(os.listdir(dst_d))
+        copies = []
+        for src, dst in moves:
+            if os.path.basename(dst) in existing[os.path.dirname(dst)]:
+                self.warn("Overwrite: " + dst)
+            if same_device:
+                try:
+                    os.replace(src, dst)
+                    continue
+                except OSError:
+                    pass
+            copies.append((src, dst))
+
+        total_size = 0
+        if len(copies) > 0:
+            total_size = self.copy_files(copies)
+        elapsed = max(time.time() - start, 1e-6)
+        self.logger.info(" finalize: {} folders renamed, {} files renamed, {} files copied ({:.1f} MB, {:.1f} MB/s)".format(
+            len(renamed_dirs), len(moves) - len(copies), len(copies), total_size / 1024 / 1024,
+            total_size / 1024 / 1024 / elapsed))
+
+    def copy_files(self, copies: List[tuple]) -> int:
+        # 並列に copy して元のファイルを削除する (進捗は 10% 毎にログに出力する)
+        total_size = sum([os.path.getsize(src) for src, dst in copies])
+        copied_size = copied_count = 0
+        next_report = 0.1
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(copies), max(4, self.jobs))) as executor:
+            futures = dict([(executor.submit(self.move_file, src, dst), (src, dst)) for src, dst in copies])
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    copied_size += future.result()
+                    copied_count += 1
+                except Exception as e:
+                    self.warn("move subject failre." + str(e))
+                if total_size > 0 and copied_size / total_size >= next_report:
+                    elapsed = max(time.time() - start, 1e-6)
+                    self.logger.info(" copy: {}/{} files ({:.0f}%, {:.1f} MB/s)".format(
+                        copied_count, len(copies), copied_size / total_size * 100,
+                        copied_size / 1024 / 1024 / elapsed))
+                    next_report = int(copied_size / total_size * 10 + 1) / 10
+        return copied_size
+
+    @classmethod
+    def move_file(cls, src: str, dst: str) -> int:
+        # 別の file system への移動 (一時ファイルに copy してから置き換え、元のファイルを削除する)
+        tmp = dst + ".bdc_tmp"
+        try:
+            with open(src, "rb") as f_src, open(tmp, "wb") as f_dst:
+                size = os.fstat(f_src.fileno()).st_size
+                cls.copy_fd(f_src, f_dst, size)
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(src)
+        return size
+
+    @classmethod
+    def copy_fd(cls, f_src, f_dst, size: int):
+        # copy_file_range (kernel 内 copy、対応 file system では reflink / server-side copy) > sendfile > read/write
+        in_fd, out_fd = f_src.fileno(), f_dst.fileno()
+        offset = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    n = os.copy_file_range(in_fd, out_fd, min(size - offset, cls.COPY_CHUNK_SIZE), offset)
+                    if n == 0:
+                        break
+                    offset += n
+            except OSError:
+                pass
+        if offset < size and hasattr(os, "sendfile"):
+            try:
+                os.lseek(out_fd, offset, os.SEEK_SET)
+                while offset < size:
+                    n = os.sendfile(out_fd, in_fd, offset, min(size - offset, cls.COPY_CHUNK_SIZE))
+                    if n == 0:
+                        break
+                    offset += n
+            except OSError:
+                pass
+        if offset < size:
+            f_src.seek(offset)
+            f_dst.seek(offset)
+            while True:
+                buf = f_src.read(cls.COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                f_dst.write(buf)
 
     def move_subject(self):
 
@@ -763,50 +1455,76 @@ class BcilDcmConvert:
             overwrite_mode = "replace"
         elif self.overwrite == 2:
             if os.path.exists(self.dst_path.study_csv):
-                dst_study_csv = self.study.read_csv(self.dst_path.study_csv).astype(self.study.d_type)
-                if not self.study.df.equals(dst_study_csv):
+                if not self.study.csv_equals(self.dst_path.study_csv, self.study.df):
                     self.close("Error: Studyinfo.csv does not match and cannot be merged. Results are in " +
                                self.work_path.subject_d)
-            if not os.path.exists(self.dst_path.series_csv) or not os.path.exists(self.dst_path.dcm_csv):
+            if not os.path.exists(self.dst_path.series_csv) or \
+                    (not os.path.exists(self.dst_path.dcm_csv) and not os.path.exists(self.dst_path.dcm_compact)):
                 self.close("Error: Data is inaccurate and cannot be merged. Results are in " + self.work_path.subject_d)
             overwrite_mode = "append"
 
         self.logger.info("Start: move subject (" + overwrite_mode + ")" + self.work_path.subject_d + " > " + self.dst_path.subject_d)
 
         if overwrite_mode == "append":
-            # ワークフォルダ内を更新する
+            # 保存先の csv を更新する
             try:
-                dst_series_csv = self.series.read_csv(self.dst_path.series_csv).astype(self.series.d_type)
-                merge_series_csv = pd.concat([dst_series_csv, self.series.df])
-                merge_series_csv = merge_series_csv.drop_duplicates(subset=['Series Number', 'Series UID'])
-                merge_series_csv = merge_series_csv.sort_values(["Series Number", "TE[msec]"]).reset_index(drop=True)
-                self.series.save_csv(self.dst_path.series_csv, merge_series_csv)  # 保存
-
-                dst_dcm_csv = self.dcm.read_csv(self.dst_path.dcm_csv).astype(self.dcm.d_type)
-                merge_dcm_csv = pd.concat([dst_dcm_csv, self.dcm.df])
-                merge_dcm_csv = merge_dcm_csv.drop_duplicates(subset=["File path", 'Series Number'])
-                merge_dcm_csv = merge_dcm_csv.sort_values(["Series Number", "Instance Number"]).reset_index(drop=True)
-                self.dcm.save_csv(self.dst_path.dcm_csv, merge_dcm_csv)  # 保存
+                if self.feather is False and self.compact_dcm_list is False and \
+                        not os.path.exists(self.dst_path.series_table) and not os.path.exists(self.dst_path.dcm_compact):
+                    # 新しい行のみを追記する
+                    append_index = DcmAppendIndex(self.dst_path.raw_data_d)
+                    try:
+                        self.append_csv_rows(self.series, self.dst_path.series_csv, self.series.df, append_index,
+                                             ['Series Number', 'Series UID'], ["Series Number", "TE[msec]"])
+                        self.append_csv_rows(self.dcm, self.dst_path.dcm_csv, self.dcm.df, append_index,
+                                             ["File path", 'Series Number'], ["Series Number", "Instance Number"])
+                    finally:
+                        append_index.close()
+                else:
+                    dst_series_csv = self.series.read_csv(self.dst_path.series_csv).astype(self.series.d_type)
+                    merge_series_csv = pd.concat([dst_series_csv, self.series.df])
+                    merge_series_csv = merge_series_csv.drop_duplicates(subset=['Series Number', 'Series UID'])
+                    merge_series_csv = merge_series_csv.sort_values(
+                        ["Series Number", "TE[msec]"]).reset_index(drop=True)
+                    self.series.save_csv(self.dst_path.series_csv, merge_series_csv)  # 保存
+
+                    dst_dcm_csv = self.dcm.read_dcm_list(
+                        self.dst_path.dcm_csv, self.dst_path.dcm_compact).astype(self.dcm.d_type)
+                    merge_dcm_csv = pd.concat([dst_dcm_csv, self.dcm.df])
+                    merge_dcm_csv = merge_dcm_csv.drop_duplicates(subset=["File path", 'Series Number'])
+                    merge_dcm_csv = merge_dcm_csv.sort_values(
+                        ["Series Number", "Instance Number"]).reset_index(drop=True)
+                    if self.compact_dcm_list is True:
+                        self.dcm.save_compact(self.dst_path.dcm_compact, merge_dcm_csv)  # 保存
+                    else:
+                        self.dcm.save_csv(self.dst_path.dcm_csv, merge_dcm_csv)  # 保存
+
+                    # Feather は csv と同じ内容に更新する
+                    if self.feather is True or os.path.exists(self.dst_path.series_table):
+                        if not self.series.table_available():
+                            self.warn("Warning: pyarrow is not installed, Feather files are not updated.")
+                        else:
+                            self.study.save_table(self.dst_path.study_table, self.study.df)
+                            self.series.save_table(self.dst_path.series_table, merge_series_csv)
+                            self.dcm.save_table(self.dst_path.dcm_table, merge_dcm_csv)
 
             except Exception as e:
                 self.warn("append subject failre." + str(e))
             csv_files = []
         else:
-            csv_files = [self.work_path.study_csv, self.work_path.series_csv, self.work_path.dcm_csv]
+            dcm_list = self.work_path.dcm_compact if self.compact_dcm_list is True else self.work_path.dcm_csv
+            csv_files = [self.work_path.study_csv, self.work_path.series_csv, dcm_list]
+            if self.feather is True:
+                csv_files += [self.work_path.study_table, self.work_path.series_table, self.work_path.dcm_table]
+
+        # 保存形式と異なる DICOM list は残さない
+        other_dcm_list = self.dst_path.dcm_csv if self.compact_dcm_list is True else self.dst_path.dcm_compact
+        if os.path.exists(other_dcm_list):
+            self.warn("Remove: " + other_dcm_list)
+            os.remove(other_dcm_list)
 
         # RawData以下
         self.mkdir(self.dst_path.raw_data_d)
-        nifti_files = glob.glob(self.work_path.nifti_d + "/*", recursive=False)
-        dcm_files = glob.glob(self.work_path.dicom_d + "/*", recursive=False)
-        for file in csv_files + nifti_files + dcm_files:
-            dst = file.replace(self.work_path.subject_d, self.dst_path.subject_d, 1)
-            self.mkdir(os.path.dirname(dst))
-            if os.path.exists(dst):
-                self.warn("Overwrite: " + dst)
-            try:
-                shutil.move(file, dst)
-            except Exception as e:
-                self.warn("move subject failre." + str(e))
+        self.finalize_files(csv_files, [self.work_path.nifti_d, self.work_path.dicom_d])
 
         # ログファイル
         self.logger = bcil_dcm_convert_logger.disposal_logger(self.logger)  # ファイルログ一旦停止
@@ -875,6 +1593,43 @@ if __name__ == '__main__':
                     dest='working_folder', type=str,
                     help="path to working folder",
                     metavar="<working folder>")
+    ap.add_argument('-j', '--jobs',
+                    dest='jobs', type=int,
+                    help="number of processes to read DICOM headers (default is 1)",
+                    default=1, metavar="<num>")
+    ap.add_argument('-i', '--index',
+                    dest='header_index', action='store_true',
+                    help='keep a DICOM header index in the parent folder, and read only new or changed files on re-runs')
+    ap.add_argument('--zip_native',
+                    dest='zip_native', action='store_true',
+                    help='read DICOM files in zipped input without unzipping (unzip only DICOM files for dcm2niix)')
+    ap.add_argument('--dicm_check',
+                    dest='dicm_check', action='store_true',
+                    help='select DICOM files by the "DICM" prefix at byte 128 instead of file names')
+    ap.add_argument('--series_nifti',
+                    dest='series_nifti', action='store_true',
+                    help='run dcm2niix for each series in parallel (number of processes is given by -j)')
+    ap.add_argument('--dcm_list_memory',
+                    dest='dcm_list_memory', type=int,
+                    help="memory size [MB] to keep the DICOM list in memory, the rest is sorted on disk (default is 1024)",
+                    metavar="<MB>")
+    ap.add_argument('--compact_dcm_list',
+                    dest='compact_dcm_list', action='store_true',
+                    help='save the DICOM list as DICOMlist.json (directory table, file names and Series UID codes) '
+                         'instead of DICOMlist.csv')
+    ap.add_argument('--feather',
+                    dest='feather', action='store_true',
+                    help='also save Studyinfo, Seriesinfo and DICOMlist as Feather (Arrow IPC) files (requires pyarrow)')
+    ap.add_argument('--catalog',
+                    dest='catalog', action='store_true',
+                    help='register the subject in the catalog (bcil_dcm_catalog.sqlite) in the parent folder')
+    ap.add_argument('--split_study',
+                    dest='split_study', action='store_true',
+                    help='save each study (Study UID) in the input to its own subject folder instead of stopping')
+    ap.add_argument('--bids_config',
+                    dest='bids_config', type=str,
+                    help='check the series against the criteria of a dcm2bids config, and log unmatched or '
+                         'ambiguous series', metavar="<config.json>")
     ap.add_argument('-v', '--version',
                     action='version', version=BcilDcmConvert.__version__,
                     help="print version number")
@@ -890,6 +1645,17 @@ if __name__ == '__main__':
         subject_name=args.subject_name,
         gz=args.gz,
         working_folder=args.working_folder,
+        jobs=args.jobs,
+        header_index=args.header_index,
+        zip_native=args.zip_native,
+        dicm_check=args.dicm_check,
+        series_nifti=args.series_nifti,
+        dcm_list_memory=args.dcm_list_memory,
+        compact_dcm_list=args.compact_dcm_list,
+        feather=args.feather,
+        catalog=args.catalog,
+        split_study=args.split_study,
+        bids_config=args.bids_config,
     )
     if bc.main() is True:
         print("completed bcil_dcm_convert.py!")
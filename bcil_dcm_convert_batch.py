@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# coding:utf-8
+import concurrent.futures
+import csv
+import datetime
+import glob
+import json
+import os
+import time
+from typing import List, Optional
+
+import pandas as pd
+
+from bcil_dcm_convert import BcilDcmConvert
+
+
+# manifest で subject 毎に指定できる BcilDcmConvert の引数と型
+MANIFEST_OPTIONS: dict = {
+    "subject_name": str,
+    "save_parent_dir": str,
+    "create_nifti": bool,
+    "overwrite": int,
+    "gz": bool,
+    "working_folder": str,
+    "jobs": int,
+    "header_index": bool,
+    "zip_native": bool,
+    "dicm_check": bool,
+    "series_nifti": bool,
+    "dcm_list_memory": int,
+    "compact_dcm_list": bool,
+    "feather": bool,
+    "catalog": bool,
+    "split_study": bool,
+    "bids_config": str,
+}
+SUMMARY_COLUMNS: list = ["Input", "Subject name", "Status", "Message", "Output", "Start", "Elapsed[sec]",
+                         "Series", "DICOMs"]
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    v = str(value).strip().lower()
+    if v in ["1", "true", "yes", "y"]:
+        return True
+    if v in ["0", "false", "no", "n", ""]:
+        return False
+    raise ValueError("invalid boolean value: " + str(value))
+
+
+def parse_subject(row: dict, defaults: dict) -> dict:
+    # manifest の 1 行 -> BcilDcmConvert の引数 (空欄は defaults のまま)
+    if "input" not in row or row["input"] in [None, ""]:
+        raise ValueError("input is required: " + json.dumps(row))
+    inputs = row["input"] if isinstance(row["input"], list) else str(row["input"]).split(";")
+    params = dict(defaults)
+    params["dcm_dir_list"] = [p.strip() for p in inputs if p.strip() != ""]
+    for key, value in row.items():
+        if key == "input" or value is None or (isinstance(value, str) and value.strip() == ""):
+            continue
+        if key not in MANIFEST_OPTIONS:
+            raise ValueError("unknown manifest column: " + key)
+        params[key] = to_bool(value) if MANIFEST_OPTIONS[key] == bool else MANIFEST_OPTIONS[key](value)
+    return params
+
+
+def read_manifest(path: str, defaults: dict) -> List[dict]:
+    # csv / json の manifest、または zip を置いたフォルダ (1 zip = 1 subject)
+    if os.path.isdir(path):
+        rows = [{"input": f} for f in sorted(glob.glob(os.path.join(path, "*.zip")))]
+    elif path.lower().endswith(".json"):
+        with open(path, mode="r", encoding="utf-8") as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get("subjects", [])
+    else:
+        with open(path, mode="r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+    return [parse_subject(row, defaults) for row in rows]
+
+
+def convert_subject(params: dict) -> dict:
+    # 1 subject の変換 (worker process 内で実行される)
+    # BcilDcmConvert は失敗時に exit() するので SystemExit も結果として返す
+    start = time.time()
+    result = {
+        "Input": ";".join(params["dcm_dir_list"]),
+        "Subject name": params.get("subject_name") or "",
+        "Status": "failed",
+        "Message": "",
+        "Output": "",
+        "Start": datetime.datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'),
+        "Elapsed[sec]": 0.0,
+        "Series": 0,
+        "DICOMs": 0,
+    }
+    bc = None
+    try:
+        bc = BcilDcmConvert(**params)
+        if bc.main() is True:
+            result["Status"] = "ok"
+    except SystemExit as e:
+        result["Message"] = "exit " + str(e.code)
+        if bc is not None and bc.close_message is not None:
+            result["Message"] = bc.close_message
+    except Exception as e:
+        result["Message"] = str(e)
+    if bc is not None:
+        if bc.dst_path is not None:
+            result["Output"] = bc.dst_path.subject_d
+        if bc.series.df is not None:
+            result["Series"] = len(bc.series.df)
+        if bc.dcm.df is not None:
+            result["DICOMs"] = len(bc.dcm.df)
+    result["Elapsed[sec]"] = round(time.time() - start, 1)
+    return result
+
+
+def output_key(params: dict) -> Optional[tuple]:
+    # 保存先 subject folder (同じ保存先の subject は同時に実行しない)。naming rule (%) の場合は不明のため None
+    name = params.get("subject_name")
+    if name is None or name == "":
+        name = os.path.basename(os.path.normpath(params["dcm_dir_list"][0]))
+        name = os.path.splitext(name)[0] if name.lower().endswith(".zip") else name
+    elif "%" in name:
+        return None
+    return os.path.abspath(params["save_parent_dir"]), name
+
+
+def run_batch(subjects: List[dict], parallel: int, summary_path: Optional[str] = None) -> pd.DataFrame:
+    # parallel 個の subject を同時に変換する (worker process は subject 間で再利用する)
+    results = [None] * len(subjects)
+    pending = list(range(len(subjects)))
+    running = {}
+    busy_keys = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, parallel)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for i in pending[:]:
+                if len(running) >= max(1, parallel):
+                    break
+                key = output_key(subjects[i])
+                if key is not None and key in busy_keys:
+                    continue
+                busy_keys.add(key)
+                pending.remove(i)
+                running[executor.submit(convert_subject, subjects[i])] = (i, key)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i, key = running.pop(future)
+                busy_keys.discard(key)
+                try:
+                    results[i] = future.result()
+                except Exception as e:  # worker process の異常終了など
+                    results[i] = convert_subject_error(subjects[i], str(e))
+                print("[{}/{}] {}: {} ({} sec)".format(
+                    len(subjects) - len(pending) - len(running), len(subjects), results[i]["Status"],
+                    results[i]["Input"], results[i]["Elapsed[sec]"]))
+    summary = pd.DataFrame(results, columns=SUMMARY_COLUMNS)
+    if summary_path is not None:
+        summary.to_csv(summary_path, index=False)
+    return summary
+
+
+def convert_subject_error(params: dict, message: str) -> dict:
+    return {"Input": ";".join(params["dcm_dir_list"]), "Subject name": params.get("subject_name") or "",
+            "Status": "failed", "Message": message, "Output": "", "Start": "", "Elapsed[sec]": 0.0,
+            "Series": 0, "DICOMs": 0}
+
+
+def add_subject_options(ap):
+    # subject 共通の設定 (manifest で上書き可能)
+    ap.add_argument('-n', '--no_nii', dest='no_nii', action='store_true', help='do not convert to NIFTI')
+    ap.add_argument('-w', dest='overwrite', type=int, default=0, choices=[0, 1, 2],
+                    help="overwrite options (0:do not overwrite, 1:replace, 2:append, default is 0)")
+    ap.add_argument('-z', '--gz', dest='gz', action='store_true', help='compress NIFTI volumes with .gz')
+    ap.add_argument('-d', dest='working_folder', type=str, help="path to working folder", metavar="<working folder>")
+    ap.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help="number of processes to read DICOM headers per subject (default is 1)", metavar="<num>")
+    ap.add_argument('-i', '--index', dest='header_index', action='store_true', help='keep a DICOM header index')
+    ap.add_argument('--zip_native', dest='zip_native', action='store_true', help='read zipped input without unzipping')
+    ap.add_argument('--dicm_check', dest='dicm_check', action='store_true', help='select DICOM files by "DICM" prefix')
+    ap.add_argument('--series_nifti', dest='series_nifti', action='store_true', help='run dcm2niix for each series')
+    ap.add_argument('--compact_dcm_list', dest='compact_dcm_list', action='store_true', help='save DICOMlist.json')
+    ap.add_argument('--feather', dest='feather', action='store_true', help='also save Feather files')
+    ap.add_argument('--catalog', dest='catalog', action='store_true', help='register subjects in the catalog')
+    ap.add_argument('--split_study', dest='split_study', action='store_true', help='save each study separately')
+    ap.add_argument('--bids_config', dest='bids_config', type=str, help='check series against a dcm2bids config',
+                    metavar="<config.json>")
+
+
+def get_subject_defaults(args) -> dict:
+    return {
+        "save_parent_dir": args.parent_dir,
+        "create_nifti": not args.no_nii,
+        "overwrite": args.overwrite,
+        "gz": args.gz,
+        "working_folder": args.working_folder,
+        "jobs": args.jobs,
+        "header_index": args.header_index,
+        "zip_native": args.zip_native,
+        "dicm_check": args.dicm_check,
+        "series_nifti": args.series_nifti,
+        "compact_dcm_list": args.compact_dcm_list,
+        "feather": args.feather,
+        "catalog": args.catalog,
+        "split_study": args.split_study,
+        "bids_config": args.bids_config,
+    }
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 bcil_dcm_convert_batch.py [option(s)] <parent folder to save> <manifest.csv>\n" \
+        "       $ python3 bcil_dcm_convert_batch.py [option(s)] <parent folder to save> <manifest.json>\n" \
+        "       $ python3 bcil_dcm_convert_batch.py [option(s)] <parent folder to save> <folder of DICOM.zip>\n" \
+        "\n" \
+        "  manifest columns (keys): input (required, ';' separated for multiple inputs), " + \
+        ", ".join(MANIFEST_OPTIONS.keys()) + "\n" \
+        "\n\n"
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('parent_dir', type=str, help="path to parent folder, to which output subject's folders will be saved")
+    ap.add_argument('manifest', type=str, help="manifest (csv or json), or folder containing DICOM.zip files")
+    ap.add_argument('-P', '--parallel',
+                    dest='parallel', type=int, default=1,
+                    help="number of subjects converted at the same time (default is 1)", metavar="<num>")
+    ap.add_argument('--summary',
+                    dest='summary', type=str,
+                    help="path to summary csv (default is <parent folder>/bcil_dcm_batch_summary_<date>.csv)",
+                    metavar="<csv>")
+    add_subject_options(ap)
+    args = ap.parse_args()
+
+    defaults = get_subject_defaults(args)
+    if not os.path.isdir(args.parent_dir):
+        print("<parent folder to save> not found. (" + args.parent_dir + ")")
+        exit(1)
+    try:
+        subject_list = read_manifest(args.manifest, defaults)
+    except (OSError, ValueError) as e:
+        print("Error: manifest: " + str(e))
+        exit(1)
+    if len(subject_list) == 0:
+        print("Error: no subject in " + args.manifest)
+        exit(1)
+
+    summary_csv = args.summary
+    if summary_csv is None:
+        summary_csv = os.path.join(
+            args.parent_dir, "bcil_dcm_batch_summary_" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + ".csv")
+    df = run_batch(subject_list, args.parallel, summary_csv)
+    print(df[["Status", "Input", "Output", "Elapsed[sec]", "Series", "DICOMs"]].to_string(index=False))
+    print("summary: " + summary_csv)
+    exit(0 if (df["Status"] == "ok").all() else 1)
@@ -1,39 +1,68 @@
 #!/usr/bin/python3
 # coding:utf-8
-import dcm2bids.dcm2bids
-from dcm2bids import Dcm2bids
 from bcil_dcm_convert import BcilDcmConvert
+from bcil_dcm_convert_nifti import NiftiMatcher
+from bcil_dcm_convert_bids_builder import BidsBuilder
+from types import SimpleNamespace
 import os
+import sys
 import glob
-import hashlib
 import pandas as pd
 
 
+def get_single_pass_arguments():
+    # dcm2bids と同じ引数 (dcm2bids / dcm2niix は実行しない)
+    from argparse import ArgumentParser
+    ap = ArgumentParser(usage="%(prog)s --single_pass -d <dicom_dir> [<dicom_dir> ...] -p <participant> "
+                              "[-s <session>] -c <config> [-o <output_dir>] [--clobber]")
+    ap.add_argument("-d", "--dicom_dir", required=True, nargs="+", help="DICOM directory(ies)")
+    ap.add_argument("-p", "--participant", required=True, help="participant ID")
+    ap.add_argument("-s", "--session", required=False, default="", help="session ID")
+    ap.add_argument("-c", "--config", required=True, help="JSON configuration file (see example/config.json)")
+    ap.add_argument("-o", "--output_dir", required=False, default=os.getcwd(), help="output BIDS directory")
+    ap.add_argument("--clobber", action="store_true", help="overwrite output if it exists")
+    return ap.parse_args()
+
+
 if __name__ == "__main__":
 
+    # --single_pass: dcm2bids を実行せず、RawData の変換結果 (1 回の header 読み込みと dcm2niix) から
+    #                config の criteria で BIDS のファイルを hard link で作成する
+    single_pass = "--single_pass" in sys.argv
+    if single_pass is True:
+        sys.argv.remove("--single_pass")
+        args = get_single_pass_arguments()
+        participant = args.participant if args.participant.startswith("sub-") else "sub-" + args.participant
+        session = args.session if args.session == "" or args.session.startswith("ses-") else "ses-" + args.session
+        app = SimpleNamespace(bidsDir=args.output_dir, dicomDirs=args.dicom_dir,
+                              participant=SimpleNamespace(name=participant, session=session))
+
     # bids 実行
-    try:
-        args = dcm2bids.dcm2bids.get_arguments()
-        if args.anonymizer:
-            print(
+    else:
+        try:
+            import dcm2bids.dcm2bids
+            from dcm2bids import Dcm2bids
+            args = dcm2bids.dcm2bids.get_arguments()
+            if args.anonymizer:
+                print(
+                    """
+                The anonymizer option no longer exists from the script in this release
+                It is still possible to deface the anatomical nifti images
+                Please add "defaceTpl" key in the congifuration file
+                For example, if you use the last version of pydeface, add:
+                "defaceTpl": "pydeface --outfile {dstFile} {srcFile}"
+                It is a template string and dcm2bids will replace {srcFile} and {dstFile}
+                by the source file (input) and the destination file (output)
                 """
-            The anonymizer option no longer exists from the script in this release
-            It is still possible to deface the anatomical nifti images
-            Please add "defaceTpl" key in the congifuration file
-            For example, if you use the last version of pydeface, add:
-            "defaceTpl": "pydeface --outfile {dstFile} {srcFile}"
-            It is a template string and dcm2bids will replace {srcFile} and {dstFile}
-            by the source file (input) and the destination file (output)
-            """
-            )
-            exit(1)
-
-        app = Dcm2bids(**vars(args))
-        app.run()
+                )
+                exit(1)
 
-    except Exception as e:
-        print('***dcm2bids error***')
-        print(e)
+            app = Dcm2bids(**vars(args))
+            app.run()
+
+        except Exception as e:
+            print('***dcm2bids error***')
+            print(e)
 
     try:
         print('***bcil_convert start***')
@@ -48,6 +77,8 @@ if __name__ == "__main__":
             convert_save_dir = app_dir
             subject_name = app.participant.name
             tmp_dir = app_dir + "tmp_dcm2bids" + os.sep + app.participant.name
+        if single_pass is True:  # dcm2bids が作成していたフォルダ
+            os.makedirs(convert_save_dir, exist_ok=True)
 
         bc = BcilDcmConvert(
             dcm_dir_list=app.dicomDirs,
@@ -60,32 +91,52 @@ if __name__ == "__main__":
         )
         bc.main()
 
-        bids_nifti_hash_list = {}
         sub_dir = (convert_save_dir + subject_name + os.sep)
 
+        if single_pass is True:
+            series = pd.read_csv(sub_dir + os.sep + r"RawData/Seriesinfo.csv", dtype=str)
+            builder = BidsBuilder(args.config, app_dir, app.participant.name, app.participant.session, args.clobber)
+            created = builder.build(series)
+            print('BIDS NIFTI: {} (linked: {}, copied: {})'.format(
+                len(created), builder.linked_count, builder.copied_count))
+            for index, item in series.iterrows():
+                if isinstance(item['NIFTI in RawData'], str):
+                    bids_nifti_ary = [created[f] for f in item['NIFTI in RawData'].split(" ") if f in created]
+                    if len(bids_nifti_ary) > 0:
+                        series.at[index, 'NIFTI in BIDS'] = " ".join(bids_nifti_ary)
+            series.to_csv(sub_dir + os.sep + r"RawData/Seriesinfo.csv", index=False)
+            exit(0)
+
         # NIFTI in BIDS list
         bids_nifti_list = glob.glob(sub_dir + r"**" + os.sep + "*.nii")
         bids_nifti_list.extend(glob.glob(sub_dir + r"**" + os.sep + "*.nii.gz"))
         bids_nifti_list.extend(glob.glob(tmp_dir + os.sep + "*.nii"))
         bids_nifti_list.extend(glob.glob(tmp_dir + os.sep + "*.nii.gz"))
 
-        for bids_nifti in bids_nifti_list:
-            nf = open(bids_nifti, 'rb').read()
-            h = hashlib.sha256(nf).hexdigest()
-            bids_nifti_hash_list[h] = bids_nifti
-
         # NIFTI in RawData
-        test = {}
         series = pd.read_csv(sub_dir + os.sep + r"RawData/Seriesinfo.csv", dtype=str)
+        raw_data_nifti_lists = {}
+        series_uids = {}
         for index, item in series.iterrows():
-            bids_nifti_ary = []
-            raw_data_nifti_list = item['NIFTI in RawData'].split(" ")
-            for raw_data_nifti in raw_data_nifti_list:
-                nf = open(raw_data_nifti, 'rb').read()
-                h = hashlib.sha256(nf).hexdigest()
-                bids_nifti_ary.append(bids_nifti_hash_list[h])
-
-            series.at[index, 'NIFTI in BIDS'] = " ".join(bids_nifti_ary)
+            if isinstance(item['NIFTI in RawData'], str) and item['NIFTI in RawData'] not in ["NONE", "None"]:
+                raw_data_nifti_lists[index] = item['NIFTI in RawData'].split(" ")
+                for raw_data_nifti in raw_data_nifti_lists[index]:
+                    series_uids[raw_data_nifti] = item['Series UID']
+
+        # sidecar -> サイズ -> hash の順に照合する (hash は app_dir の cache を再利用する)
+        matcher = NiftiMatcher(app_dir)
+        try:
+            matched = matcher.match(sum(raw_data_nifti_lists.values(), []), bids_nifti_list, series_uids)
+        finally:
+            matcher.close()
+        print('NIFTI matched: {}/{} (sidecar: {}, hashed: {})'.format(
+            len([v for v in matched.values() if v is not None]), len(matched), matcher.sidecar_count,
+            matcher.hashed_count))
+
+        for index, raw_data_nifti_list in raw_data_nifti_lists.items():
+            bids_nifti_ary = [matched[f] for f in raw_data_nifti_list if matched[f] is not None]
+            if len(bids_nifti_ary) > 0:
+                series.at[index, 'NIFTI in BIDS'] = " ".join(bids_nifti_ary)
 
         series.to_csv(sub_dir + os.sep + r"RawData/Seriesinfo.csv", index=False)
 
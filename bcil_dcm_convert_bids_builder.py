@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# coding:utf-8
+import errno
+import json
+import os
+import shutil
+from typing import Optional, List
+
+import pandas as pd
+
+from bcil_dcm_convert_criteria import DcmCriteriaMatcher
+
+
+class BidsBuilder:
+    # dcm2bids の config (descriptions / criteria) を RawData の NIFTI に適用し、
+    # dcm2niix を再実行せずに BIDS のファイルを hard link (不可の場合は copy) で作成する
+
+    companion_exts: list = [".json", ".bval", ".bvec"]
+
+    def __init__(self, config_path: str, bids_dir: str, participant: str, session: str = "",
+                 clobber: bool = False):
+        self.matcher = DcmCriteriaMatcher.from_config(config_path)
+        self.descriptions = self.matcher.descriptions
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.participant = participant[4:] if participant.startswith("sub-") else participant
+        self.session = session[4:] if session.startswith("ses-") else session
+        self.clobber = clobber
+        self.linked_count = 0
+        self.copied_count = 0
+
+    @property
+    def prefix(self) -> str:
+        return "sub-" + self.participant + ("_ses-" + self.session if self.session != "" else "")
+
+    @property
+    def directory(self) -> str:
+        d = os.path.join(self.bids_dir, "sub-" + self.participant)
+        return os.path.join(d, "ses-" + self.session) if self.session != "" else d
+
+    @staticmethod
+    def get_stem(nifti_path: str) -> str:
+        for ext in [".nii.gz", ".nii"]:
+            if nifti_path.endswith(ext):
+                return nifti_path[:-len(ext)]
+        return os.path.splitext(nifti_path)[0]
+
+    def get_sidecar_data(self, nifti_path: str, series_row: pd.Series) -> dict:
+        # dcm2niix の sidecar の値 (sidecar に無いキーは Seriesinfo.csv の値)
+        data = self.matcher.series_to_data(series_row)
+        try:
+            with open(self.get_stem(nifti_path) + ".json", mode="r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+            if isinstance(sidecar, dict):
+                data.update(sidecar)
+        except (OSError, ValueError):
+            pass
+        return data
+
+    def get_description_index(self, data: dict) -> Optional[int]:
+        # 一致する description が 1 つの場合のみ採用する (複数一致は dcm2bids と同様に使わない)
+        found = self.matcher.match(data)
+        return found[0] if len(found) == 1 else None
+
+    def get_acquisitions(self, series_df: pd.DataFrame) -> List[tuple]:
+        # (RawData の NIFTI, description, BIDS の NIFTI の拡張子を除いたパス)
+        acquisitions = []
+        order = pd.to_numeric(series_df["Series Number"], errors="coerce").argsort(kind="stable")
+        for index, row in series_df.iloc[order].iterrows():
+            files = row.get("NIFTI in RawData")
+            if not isinstance(files, str) or files in ["", "NONE", "None"]:
+                continue
+            for nifti in files.split(" "):
+                i = self.get_description_index(self.get_sidecar_data(nifti, row))
+                if i is not None:
+                    acquisitions.append((nifti, self.descriptions[i]))
+
+        # 同じ出力名のものには run-XX を付ける
+        labels = []
+        for nifti, description in acquisitions:
+            v = description.get("customLabels", "")
+            labels.append("_".join(v) if isinstance(v, list) else v)
+        roots = [self.get_root(d, v) for (n, d), v in zip(acquisitions, labels)]
+        result = []
+        for i, (nifti, description) in enumerate(acquisitions):
+            root = roots[i]
+            if roots.count(root) > 1:
+                run = "run-{:02d}".format(roots[:i + 1].count(root))
+                root = self.get_root(description, "_".join(filter(None, [labels[i], run])))
+            result.append((nifti, description, root))
+        return result
+
+    def get_root(self, description: dict, labels: str) -> str:
+        name = "_".join(filter(None, [self.prefix, labels, description["modalityLabel"]]))
+        return os.path.join(self.directory, description["dataType"], name)
+
+    def place(self, src: str, dst: str, data: Optional[dict] = None):
+        # hard link (別デバイス等で不可の場合は copy)。data がある場合は json を書き出す
+        if os.path.lexists(dst):
+            if self.clobber is False:
+                return
+            os.remove(dst)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if data is not None:
+            with open(dst, mode="w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4)
+            return
+        try:
+            os.link(src, dst)
+            self.linked_count += 1
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+                raise
+            shutil.copy2(src, dst)
+            self.copied_count += 1
+
+    def build(self, series_df: pd.DataFrame) -> dict:
+        # RawData の NIFTI -> 作成した BIDS の NIFTI
+        result = {}
+        for nifti, description, root in self.get_acquisitions(series_df):
+            src_stem = self.get_stem(nifti)
+            nii_ext = nifti[len(src_stem):]
+            self.place(nifti, root + nii_ext)
+            for ext in self.companion_exts:
+                if not os.path.exists(src_stem + ext):
+                    continue
+                data = None
+                if ext == ".json" and description["dataType"] == "func":  # func は TaskName が必須
+                    task = [v[5:] for v in os.path.basename(root).split("_") if v.startswith("task-")]
+                    if len(task) > 0:
+                        with open(src_stem + ext, mode="r", encoding="utf-8") as f:
+                            data = json.load(f)
+                        data["TaskName"] = task[0]
+                self.place(src_stem + ext, root + ext, data)
+            result[nifti] = root + nii_ext
+        return result
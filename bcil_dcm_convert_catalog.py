@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# coding:utf-8
+import glob
+import os
+import sqlite3
+import sys
+from typing import Optional, List
+
+import pandas as pd
+
+from bcil_dcm_convert_csv import BaseCsvData, SeriesCsvData, StudyCsvData, DcmCsvData
+
+
+class DcmCatalog:
+    # 保存先 parent dir 内の全 subject の Studyinfo / Seriesinfo / DICOMlist をまとめて保持する
+
+    file_name: str = "bcil_dcm_catalog.sqlite"
+    catalog_version: str = "1"
+
+    # table 名 -> (CsvData, index を作る列)
+    tables: dict = {
+        "study": (StudyCsvData, ["StudyUID", "Patient ID", "Study Date"]),
+        "series": (SeriesCsvData, ["Series UID", "Series Number", "Protocol", "Description", "Sequence Name"]),
+        "dicom": (DcmCsvData, ["Series UID", "File path"]),
+    }
+    sql_type: dict = {str: "TEXT", int: "INTEGER", float: "REAL"}
+
+    def __init__(self, parent_dir: str):
+        self.path = os.path.join(parent_dir, self.file_name)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # 更新中も他プロセスから読めるようにする
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != self.catalog_version:  # 形式が異なる場合は作り直す (rebuild で再登録)
+                for table in ["subject"] + list(self.tables.keys()):
+                    self.conn.execute("DROP TABLE IF EXISTS " + table)
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                                  (self.catalog_version,))
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS subject ("
+                "subject_id INTEGER PRIMARY KEY, subject_d TEXT UNIQUE, subject_name TEXT, updated TEXT)")
+            for table, (data_class, index_cols) in self.tables.items():
+                cols = ", ".join([self.quote(k) + " " + self.sql_type[v["dtype"]]
+                                  for k, v in data_class.setting.items()])
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS " + table + " (subject_id INTEGER NOT NULL, " + cols + ")")
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS " + table + "_subject ON " + table + " (subject_id)")
+                for i, col in enumerate(index_cols):
+                    self.conn.execute(
+                        "CREATE INDEX IF NOT EXISTS " + table + "_" + str(i) + " ON " + table +
+                        " (" + self.quote(col) + ")")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    @staticmethod
+    def to_rows(data: BaseCsvData, df: pd.DataFrame) -> list:
+        # "None" / NaN は NULL とする
+        rows = []
+        for row in df[list(data.setting.keys())].astype(object).itertuples(index=False, name=None):
+            rows.append(tuple([None if v is None or (isinstance(v, float) and v != v) or v == "None"
+                               else (v.item() if hasattr(v, "item") else v) for v in row]))
+        return rows
+
+    def update_subject(self, subject_d: str, study_df: pd.DataFrame, series_df: pd.DataFrame,
+                       dcm_df: pd.DataFrame):
+        # subject 単位で置き換える (1 transaction)
+        subject_d = os.path.abspath(subject_d)
+        dfs = {"study": study_df, "series": series_df, "dicom": dcm_df}
+        self.conn.execute("BEGIN IMMEDIATE")  # 書き込みロックを先に取り、並列実行時は待つ
+        try:
+            row = self.conn.execute("SELECT subject_id FROM subject WHERE subject_d = ?", (subject_d,)).fetchone()
+            if row is None:
+                subject_id = self.conn.execute(
+                    "INSERT INTO subject (subject_d, subject_name, updated) VALUES (?, ?, datetime('now'))",
+                    (subject_d, os.path.basename(subject_d.rstrip(os.sep)))).lastrowid
+            else:
+                subject_id = row[0]
+                self.conn.execute("UPDATE subject SET updated = datetime('now') WHERE subject_id = ?", (subject_id,))
+            for table, (data_class, index_cols) in self.tables.items():
+                data = data_class()
+                self.conn.execute("DELETE FROM " + table + " WHERE subject_id = ?", (subject_id,))
+                self.conn.executemany(
+                    "INSERT INTO " + table + " VALUES (?, " + ", ".join(["?"] * len(data.setting)) + ")",
+                    [(subject_id,) + r for r in self.to_rows(data, dfs[table])])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def update_subject_dir(self, subject_d: str) -> bool:
+        # subject dir の RawData 以下の csv から登録する
+        raw_data_d = os.path.join(subject_d, "RawData")
+        study_csv = os.path.join(raw_data_d, "Studyinfo.csv")
+        series_csv = os.path.join(raw_data_d, "Seriesinfo.csv")
+        dcm_csv = os.path.join(raw_data_d, "DICOMlist.csv")
+        dcm_compact = os.path.join(raw_data_d, "DICOMlist.json")
+        if not os.path.exists(study_csv) or not os.path.exists(series_csv) or \
+                (not os.path.exists(dcm_csv) and not os.path.exists(dcm_compact)):
+            return False
+        study, series, dcm = StudyCsvData(), SeriesCsvData(), DcmCsvData()
+        self.update_subject(
+            subject_d,
+            study.read_csv(study_csv).astype(study.d_type),
+            series.read_csv(series_csv).astype(series.d_type),
+            dcm.read_dcm_list(dcm_csv, dcm_compact).astype(dcm.d_type))
+        return True
+
+    def remove_subject(self, subject_d: str):
+        subject_d = os.path.abspath(subject_d)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT subject_id FROM subject WHERE subject_d = ?", (subject_d,)).fetchone()
+            if row is not None:
+                for table in self.tables.keys():
+                    self.conn.execute("DELETE FROM " + table + " WHERE subject_id = ?", (row[0],))
+                self.conn.execute("DELETE FROM subject WHERE subject_id = ?", (row[0],))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def rebuild(self, parent_dir: str) -> int:
+        # parent dir 直下の subject を全て登録し直す
+        count = 0
+        registered = [r[0] for r in self.conn.execute("SELECT subject_d FROM subject").fetchall()]
+        for subject_d in registered:
+            if not os.path.isdir(subject_d):
+                self.remove_subject(subject_d)
+        for raw_data_d in sorted(glob.glob(os.path.join(parent_dir, "*", "RawData"))):
+            if self.update_subject_dir(os.path.dirname(raw_data_d)):
+                count += 1
+        return count
+
+    def query(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def find(self, table: str, conditions: Optional[dict] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        # conditions: 列名 -> 値 (一致) または (min, max) (数値として範囲指定, None は制限なし)
+        if table not in self.tables:
+            raise ValueError("unknown table: " + table)
+        setting = self.tables[table][0].setting
+        for col in (columns or []):
+            if col not in setting:
+                raise ValueError("unknown column: " + col)
+        select_cols = ["subject.subject_name", "subject.subject_d"] + \
+            [table + "." + self.quote(c) for c in (columns if columns is not None else setting)]
+        where = []
+        params = []
+        for col, value in (conditions or {}).items():
+            if col not in setting:
+                raise ValueError("unknown column: " + col)
+            if isinstance(value, tuple):
+                for op, v in zip([">=", "<="], value):
+                    if v is not None:
+                        where.append("CAST(" + table + "." + self.quote(col) + " AS REAL) " + op + " ?")
+                        params.append(v)
+            else:
+                where.append(table + "." + self.quote(col) + " = ?")
+                params.append(value)
+        sql = "SELECT " + ", ".join(select_cols) + " FROM " + table + \
+              " JOIN subject ON subject.subject_id = " + table + ".subject_id"
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        return self.query(sql, tuple(params))
+
+    @staticmethod
+    def parse_condition(condition: str) -> tuple:
+        # "col=value" または "col=min:max" (min, max は省略可)
+        col, value = condition.split("=", 1)
+        if ":" in value:
+            v_min, v_max = value.split(":", 1)
+            return col, (float(v_min) if v_min != "" else None, float(v_max) if v_max != "" else None)
+        return col, value
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 {} <parent folder> series \"Multi-band factor=8\" \"DwelltimePhase=0.5:0.7\"\n" \
+        "       $ python3 {} <parent folder> --sql \"SELECT count(*) FROM dicom\"\n" \
+        "       $ python3 {} <parent folder> --rebuild\n" \
+        "\n\n" \
+        "".format(__file__, __file__, __file__)
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('parent_dir', type=str, help="parent folder of the subjects (location of " + DcmCatalog.file_name + ")")
+    ap.add_argument('table', type=str, nargs="?", choices=list(DcmCatalog.tables.keys()), help="table to search")
+    ap.add_argument('conditions', type=str, nargs="*", help='"column=value" or "column=min:max"')
+    ap.add_argument('-c', dest='columns', type=str, action="append", help="column to output (repeatable)")
+    ap.add_argument('--sql', dest='sql', type=str, help="run an SQL query")
+    ap.add_argument('--rebuild', dest='rebuild', action='store_true', help="register all subjects in the parent folder")
+    args = ap.parse_args()
+
+    if not os.path.isdir(args.parent_dir):
+        print("<parent folder> not found. (" + args.parent_dir + ")")
+        exit(1)
+    catalog = DcmCatalog(args.parent_dir)
+    try:
+        if args.rebuild is True:
+            print("registered subjects: " + str(catalog.rebuild(args.parent_dir)))
+        if args.sql is not None:
+            catalog.query(args.sql).to_csv(sys.stdout, index=False)
+        elif args.table is not None:
+            catalog.find(args.table, dict([catalog.parse_condition(c) for c in args.conditions]),
+                         args.columns).to_csv(sys.stdout, index=False)
+    except (ValueError, sqlite3.Error) as e:
+        print("Error: " + str(e))
+        exit(1)
+    finally:
+        catalog.close()
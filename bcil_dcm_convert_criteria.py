@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# coding:utf-8
+import json
+import re
+from fnmatch import translate
+from typing import Optional, List
+
+import pandas as pd
+
+
+class DcmCriteriaMatcher:
+    # dcm2bids の config (descriptions の criteria) を 1 回だけ compile して照合する
+    # wildcard を含まない値は (tag, 値) の hash bucket で候補を絞り、wildcard は compile 済みの正規表現で判定する
+
+    wildcard_chars: str = "*?["
+
+    # criteria のキー (sidecar) -> Seriesinfo.csv の列
+    series_col: dict = {
+        "SeriesNumber": "Series Number",
+        "SeriesDescription": "Description",
+        "ProtocolName": "Protocol",
+        "SequenceName": "Sequence Name",
+        "ImageType": "Image Type",
+        "MultibandAccelerationFactor": "Multi-band factor",
+        "SeriesInstanceUID": "Series UID",
+    }
+
+    def __init__(self, descriptions: List[dict]):
+        self.descriptions = descriptions
+        self.criteria = [self.compile_criteria(d.get("criteria", {})) for d in descriptions]
+        self.all_indexes = list(range(len(descriptions)))
+
+        # description 毎に最も候補を絞れる完全一致の (tag, 値) を 1 つ選び bucket に登録する
+        counts = {}
+        for criteria in self.criteria:
+            for tag, (kind, value) in criteria.items():
+                if kind == "exact":
+                    counts[(tag, value)] = counts.get((tag, value), 0) + 1
+        self.buckets = {}  # tag -> {値: [description index]}
+        self.unindexed = []  # 完全一致の条件が無い description
+        for i, criteria in enumerate(self.criteria):
+            keys = [(tag, value) for tag, (kind, value) in criteria.items() if kind == "exact"]
+            if len(keys) == 0:
+                self.unindexed.append(i)
+                continue
+            tag, value = min(keys, key=lambda k: counts[k])
+            self.buckets.setdefault(tag, {}).setdefault(value, []).append(i)
+        self.bucket_indexes = dict([(tag, sum(b.values(), [])) for tag, b in self.buckets.items()])
+
+    @classmethod
+    def from_config(cls, config_path: str) -> "DcmCriteriaMatcher":
+        with open(config_path, mode="r", encoding="utf-8") as f:
+            return cls(json.load(f).get("descriptions", []))
+
+    @classmethod
+    def compile_value(cls, pattern) -> tuple:
+        # ("exact", 文字列) または ("regex", 正規表現)。dcm2bids と同様に str にして fnmatch と同じ判定をする
+        pattern = str(pattern)
+        if any([c in pattern for c in cls.wildcard_chars]):
+            return "regex", re.compile(translate(pattern))
+        return "exact", pattern
+
+    @classmethod
+    def compile_criteria(cls, criteria: dict) -> dict:
+        # tag -> (kind, value)。リストは要素毎に compile し、全要素が完全一致なら tuple で bucket に使う
+        compiled = {}
+        for tag, pattern in criteria.items():
+            if isinstance(pattern, list):
+                values = [cls.compile_value(p) for p in pattern]
+                if all([kind == "exact" for kind, v in values]):
+                    compiled[tag] = ("exact", tuple([v for kind, v in values]))
+                else:
+                    compiled[tag] = ("list", values)
+            else:
+                compiled[tag] = cls.compile_value(pattern)
+        return compiled
+
+    @staticmethod
+    def to_key(value):
+        return tuple([str(v) for v in value]) if isinstance(value, list) else str(value)
+
+    @staticmethod
+    def is_match_value(kind: str, pattern, name) -> bool:
+        if kind == "list":
+            if not isinstance(name, list) or len(name) != len(pattern):
+                return False
+            return all([(p == str(n)) if k == "exact" else (p.match(str(n)) is not None)
+                        for (k, p), n in zip(pattern, name)])
+        if isinstance(name, list):  # dcm2bids はリスト同士のみ一致とする
+            return kind == "exact" and isinstance(pattern, tuple) and tuple([str(n) for n in name]) == pattern
+        if kind == "exact":
+            return not isinstance(pattern, tuple) and str(name) == pattern
+        return pattern.match(str(name)) is not None
+
+    def get_candidates(self, data: dict, available: Optional[set] = None) -> List[int]:
+        candidates = set(self.unindexed)
+        for tag, bucket in self.buckets.items():
+            if available is not None and tag not in available:  # 判定できない tag の bucket は全て候補
+                candidates.update(self.bucket_indexes[tag])
+            else:
+                candidates.update(bucket.get(self.to_key(data.get(tag, "")), []))
+        return sorted(candidates)
+
+    def match(self, data: dict, available: Optional[set] = None) -> List[int]:
+        # data (sidecar) に一致する description の index
+        # available: 判定に使える tag (それ以外の tag の条件は満たすものとする)。None の場合は全 tag
+        found = []
+        for i in self.get_candidates(data, available):
+            if all([self.is_match_value(kind, pattern, data.get(tag, ""))
+                    for tag, (kind, pattern) in self.criteria[i].items()
+                    if available is None or tag in available]):
+                found.append(i)
+        return found
+
+    def get_unverified(self, indexes: List[int], available: set) -> List[str]:
+        # 照合できなかった tag
+        return sorted(set([tag for i in indexes for tag in self.criteria[i] if tag not in available]))
+
+    def series_to_data(self, row: pd.Series) -> dict:
+        data = {}
+        for tag, col in self.series_col.items():
+            v = row.get(col)
+            if v is None or (isinstance(v, float) and v != v) or str(v) in ["", "NONE", "None"]:
+                continue
+            data[tag] = str(v).split(" ") if tag == "ImageType" else v
+        return data
+
+    def get_label(self, i: int) -> str:
+        d = self.descriptions[i]
+        labels = d.get("customLabels", "")
+        labels = "_".join(labels) if isinstance(labels, list) else labels
+        return d.get("dataType", "") + "/" + "_".join(filter(None, [labels, d.get("modalityLabel", "")]))
+
+    def match_series(self, series_df: pd.DataFrame) -> pd.DataFrame:
+        # series 毎の照合結果 (Status: matched / ambiguous / unmatched)
+        # Seriesinfo に無い tag (PhaseEncodingDirection 等) や値が空 (NONE) の tag の条件は Unverified に列挙する
+        rows = []
+        for _, row in series_df.iterrows():
+            data = self.series_to_data(row)
+            available = set(data.keys())
+            found = self.match(data, available)
+            rows.append({
+                "Series Number": row.get("Series Number"),
+                "Description": row.get("Description"),
+                "Status": "unmatched" if len(found) == 0 else ("matched" if len(found) == 1 else "ambiguous"),
+                "BIDS": " ".join([self.get_label(i) for i in found]),
+                "Unverified": " ".join(self.get_unverified(found, available)),
+            })
+        return pd.DataFrame(rows, columns=["Series Number", "Description", "Status", "BIDS", "Unverified"])
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 bcil_dcm_convert_criteria.py <config.json> <Seriesinfo.csv>\n" \
+        "\n\n"
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('config', type=str, help="dcm2bids config (json)")
+    ap.add_argument('series_csv', type=str, help="Seriesinfo.csv")
+    args = ap.parse_args()
+
+    matcher = DcmCriteriaMatcher.from_config(args.config)
+    result = matcher.match_series(pd.read_csv(args.series_csv, dtype=str))
+    print(result.to_string(index=False))
+    exit(0 if (result["Status"] == "matched").all() else 1)
@@ -1,5 +1,19 @@
 import pandas as pd
 import numpy as np
+import os
+import sys
+import csv
+import json
+import heapq
+import tempfile
+from array import array
+from typing import Optional
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:  # pyarrow は任意 (Feather 形式の入出力のみで使用)
+    pyarrow = None
 
 
 class BaseCsvData:
@@ -8,6 +22,7 @@ class BaseCsvData:
 
     data_dict: dict = {}
     d_type: dict = {}
+    unique_index: dict = {}
 
     df = None
 
@@ -16,9 +31,12 @@ class BaseCsvData:
         self.d_type = dict([(k, v["dtype"]) for k, v in self.setting.items()])
         self.fillna_str = dict([(k, {"None": v["fil_val"]}) for k, v in self.setting.items() if v["dtype"] == str])
         self.fillna_not_str = dict([(k, v["fil_val"]) for k, v in self.setting.items() if v["dtype"] != str])
+        self.unique_index = {}  # unique_col_name の値 -> 最初の行番号
 
     def add_row(self, column, value):
         if column in self.data_dict.keys():
+            if column == self.unique_col_name and value not in self.unique_index:
+                self.unique_index[value] = len(self.data_dict[column])
             self.data_dict[column].append(value)
 
     def add_row_dict(self, column_value: dict):
@@ -36,12 +54,60 @@ class BaseCsvData:
         return df
 
     def save_csv(self, path: str, df: pd.DataFrame):
+        # 一時ファイルに書いてから置き換える
         df = self.fill_none(df)
+        tmp_path = path + ".tmp"
         if self.__class__.__name__ == "StudyCsvData":
             df = df.T
-            df.to_csv(path, header=False, mode="w")
+            df.to_csv(tmp_path, header=False, mode="w")
         else:
-            df.to_csv(path, index=False, mode="w")
+            df.to_csv(tmp_path, index=False, mode="w")
+        os.replace(tmp_path, path)
+
+    def append_csv(self, path: str, df: pd.DataFrame):
+        # 既存の csv の末尾に行を追記する (StudyCsvData は対象外)
+        # 書き込みに失敗した場合は元のサイズに戻す (既存の行は読み書きしない)
+        # kill や電源断で途切れた末尾の行は次回の追記前に repair_csv で取り除く
+        data = self.fill_none(df).to_csv(index=False, header=False).encode("utf-8")
+        with open(path, mode="ab") as f:
+            size = f.seek(0, os.SEEK_END)
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                f.truncate(size)
+                raise
+
+    @staticmethod
+    def repair_csv(path: str, size: int) -> Optional[int]:
+        # 前回の追記後のサイズ (size) より後ろが途切れた行で終わる場合は、その行を取り除いたサイズに戻す
+        # size より後ろの完全な行は残す。修復した場合は戻したサイズ
+        with open(path, mode="r+b") as f:
+            end = f.seek(0, os.SEEK_END)
+            if size >= end:
+                return None
+            f.seek(size)
+            tail = f.read()
+            if tail.endswith(b"\n") and b"\0" not in tail:
+                return None
+            cut = size + tail.split(b"\0")[0].rfind(b"\n") + 1
+            f.truncate(cut)
+            f.flush()
+            os.fsync(f.fileno())
+        return cut
+
+    def csv_equals(self, path: str, df: pd.DataFrame) -> bool:
+        # 保存済みの csv と同じ内容か (バイト列が異なる場合は読み込んだ DataFrame で比較する)
+        fill_df = self.fill_none(df)
+        if self.__class__.__name__ == "StudyCsvData":
+            text = fill_df.T.to_csv(header=False)
+        else:
+            text = fill_df.to_csv(index=False)
+        with open(path, mode="r", encoding="utf-8", newline="") as f:
+            if f.read() == text:
+                return True
+        return df.equals(self.read_csv(path).astype(self.d_type))
 
     def read_csv(self, path: str) -> pd.DataFrame:
 
@@ -56,9 +122,43 @@ class BaseCsvData:
         csv_df = csv_df.replace(rep_dict)
         return csv_df
 
+    @staticmethod
+    def table_available() -> bool:
+        return pyarrow is not None
+
+    def table_schema(self):
+        arrow_type = {str: pyarrow.string(), int: pyarrow.int64(), float: pyarrow.float64()}
+        setting = dict([(k, {"dtype": v["dtype"].__name__, "fil_val": v["fil_val"]}) for k, v in self.setting.items()])
+        return pyarrow.schema([(k, arrow_type[v["dtype"]]) for k, v in self.setting.items()],
+                              metadata={"bcil_dcm_convert": json.dumps(setting)})
+
+    def save_table(self, path: str, df: pd.DataFrame):
+        # Arrow IPC (Feather v2, 非圧縮) で保存する。欠損値は null とし、setting (dtype, fil_val) は schema の metadata に残す
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to save " + path)
+        df = df.astype(self.d_type)
+        table = pyarrow.Table.from_pandas(df, schema=self.table_schema(), preserve_index=False)
+        pyarrow.feather.write_feather(table, path, compression="uncompressed")
+
+    def read_table(self, path: str, zero_copy: bool = False) -> pd.DataFrame:
+        # zero_copy の場合は memory map した Arrow の列をそのまま使う
+        # それ以外は read_csv(...).astype(d_type) と同じ DataFrame を返す
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to read " + path)
+        table = pyarrow.feather.read_table(path, memory_map=True)
+        if zero_copy is True:
+            return table.to_pandas(types_mapper=pd.ArrowDtype)
+        return table.to_pandas().astype(self.d_type)
+
     def get_unique_col(self) -> list:
         return self.data_dict[self.unique_col_name][:]
 
+    def has_unique(self, value) -> bool:
+        return value in self.unique_index
+
+    def get_unique_values(self) -> list:
+        return list(self.unique_index.keys())
+
 
 class SeriesCsvData(BaseCsvData):
     unique_col_name: str = "Series UID"
@@ -132,3 +232,180 @@ class DcmCsvData(BaseCsvData):
         'Series UID': {"dtype": str, "fil_val": "NONE", },
     }
 
+    # read_dcm_header の行は型付き配列で保持し、memory_limit を超えた分は sort 済みの一時ファイルに退避する
+    memory_limit: int = 1024 * 1024 * 1024
+    spill_dir: Optional[str] = None
+    sort_col: list = ["Series Number", "Instance Number"]
+
+    # compact 形式 (ディレクトリ prefix 表 + basename, Series UID の辞書符号化)
+    compact_format: str = "bcil_dcm_list_compact"
+    compact_version: int = 1
+    compact_col: list = ["Series Number", "Instance Number", "Directory", "File name", "Series UID"]
+
+    def __init__(self):
+        super().__init__()
+        self.dirs = []
+        self.dir_index = {}
+        self.uids = []
+        self.uid_index = {}
+        self.clear_records()
+        self.spill_files = []
+
+    def clear_records(self):
+        self.series_numbers = array("i")
+        self.instance_numbers = array("i")
+        self.dir_codes = array("i")
+        self.file_names = []
+        self.uid_codes = array("i")
+        self.records_size = 0
+
+    @staticmethod
+    def split_path(file_path: str) -> tuple:
+        # 末尾の区切り文字までを prefix とし、prefix + basename で元のパスに戻す
+        i = max(file_path.rfind("/"), file_path.rfind(os.sep)) + 1
+        return file_path[:i], file_path[i:]
+
+    @staticmethod
+    def get_code(value: str, values: list, index: dict) -> int:
+        code = index.get(value)
+        if code is None:
+            code = len(values)
+            index[value] = code
+            values.append(value)
+        return code
+
+    def add_record(self, series_number: int, instance_number: int, file_path: str, series_uid: str):
+        dir_name, file_name = self.split_path(file_path)
+        if dir_name not in self.dir_index:
+            self.records_size += sys.getsizeof(dir_name)
+        self.series_numbers.append(series_number)
+        self.instance_numbers.append(instance_number)
+        self.dir_codes.append(self.get_code(dir_name, self.dirs, self.dir_index))
+        self.file_names.append(file_name)
+        self.uid_codes.append(self.get_code(series_uid, self.uids, self.uid_index))
+        self.records_size += 16 + 8 + sys.getsizeof(file_name)  # int32 x4 + list の参照 + basename
+        if self.records_size > self.memory_limit:
+            self.spill_records()
+
+    def get_file_path(self, i: int) -> str:
+        return self.dirs[self.dir_codes[i]] + self.file_names[i]
+
+    def sorted_record_index(self) -> np.ndarray:
+        # 安定ソート (Series Number, Instance Number)
+        return np.lexsort((np.frombuffer(self.instance_numbers, dtype=np.int32),
+                           np.frombuffer(self.series_numbers, dtype=np.int32)))
+
+    def spill_records(self):
+        fd, path = tempfile.mkstemp(prefix="dcm_list_", suffix=".csv", dir=self.spill_dir)
+        with os.fdopen(fd, mode="w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            for i in self.sorted_record_index():
+                writer.writerow([self.series_numbers[i], self.instance_numbers[i],
+                                 self.get_file_path(i), self.uids[self.uid_codes[i]]])
+        self.spill_files.append((path, len(self.file_names)))
+        self.clear_records()
+
+    def to_categorical_uid(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Series UID は categorical で保持する (保存時の値は str と同じ)
+        df["Series UID"] = df["Series UID"].astype("category")
+        return df
+
+    def records_to_df(self, path: str, compact_path: Optional[str] = None) -> pd.DataFrame:
+        # sort して path (compact_path 指定時は compact 形式) に一度だけ保存する
+        if len(self.spill_files) == 0:
+            index = self.sorted_record_index()
+            dir_codes = np.frombuffer(self.dir_codes, dtype=np.int32)[index]
+            df = pd.DataFrame({
+                "Series Number": np.frombuffer(self.series_numbers, dtype=np.int32)[index],
+                "Instance Number": np.frombuffer(self.instance_numbers, dtype=np.int32)[index],
+                "File path": [self.dirs[d] + self.file_names[i] for d, i in zip(dir_codes, index)],
+                "Series UID": pd.Categorical.from_codes(
+                    np.frombuffer(self.uid_codes, dtype=np.int32)[index], categories=self.uids),
+            }).astype({"Series Number": int, "Instance Number": int, "File path": str})
+            self.clear_records()
+            if compact_path is None:
+                self.save_csv(path, df)
+            else:
+                self.save_compact(compact_path, df)
+            return df
+
+        # 退避したファイルを merge して保存し、読み込み直す
+        self.spill_records()
+        readers = [open(p, mode="r", encoding="utf-8", newline="") for p, n in self.spill_files]
+        try:
+            rows = heapq.merge(*[csv.reader(r) for r in readers], key=lambda x: (int(x[0]), int(x[1])))
+            with open(path, mode="w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f, lineterminator=os.linesep)
+                writer.writerow(list(self.setting.keys()))
+                writer.writerows(rows)
+        finally:
+            for r in readers:
+                r.close()
+            for p, n in self.spill_files:
+                os.remove(p)
+            self.spill_files = []
+        df = self.to_categorical_uid(self.read_csv(path).astype(self.d_type))
+        if compact_path is not None:
+            self.save_compact(compact_path, df)
+            os.remove(path)
+        return df
+
+    def save_compact(self, path: str, df: pd.DataFrame):
+        # 行は [Series Number, Instance Number, Directory の番号, File name, Series UID の番号]
+        dirs = []
+        dir_index = {}
+        names = []
+        for file_path in df["File path"]:
+            dir_name, file_name = self.split_path(file_path)
+            names.append((self.get_code(dir_name, dirs, dir_index), file_name))
+        uid = df["Series UID"].astype("category").cat
+        data = {
+            "format": self.compact_format,
+            "version": self.compact_version,
+            "columns": self.compact_col,
+            "directories": dirs,
+            "series_uids": [str(u) for u in uid.categories],
+            "rows": [[int(sn), int(inst), d, name, int(u)] for sn, inst, (d, name), u in zip(
+                df["Series Number"], df["Instance Number"], names, uid.codes)],
+        }
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    def read_compact(self, path: str) -> pd.DataFrame:
+        # read_csv と同じ (str の) DataFrame に戻す
+        with open(path, mode="r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != self.compact_format or data.get("version") != self.compact_version:
+            raise ValueError("unsupported DICOM list format: " + path)
+        dirs = data["directories"]
+        uids = data["series_uids"]
+        rows = data["rows"]
+        return pd.DataFrame({
+            "Series Number": [str(r[0]) for r in rows],
+            "Instance Number": [str(r[1]) for r in rows],
+            "File path": [dirs[r[2]] + r[3] for r in rows],
+            "Series UID": [uids[r[4]] for r in rows],
+        }, columns=list(self.setting.keys()), dtype=str)
+
+    def read_dcm_list(self, path: str, compact_path: str) -> pd.DataFrame:
+        # compact 形式があればそちらを読む
+        if os.path.exists(compact_path):
+            return self.read_compact(compact_path)
+        return self.read_csv(path)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 {} DICOMlist.json DICOMlist.csv\n" \
+        "\n\n" \
+        "".format(__file__)
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('compact_path', type=str, help="compact DICOM list (DICOMlist.json)")
+    ap.add_argument('csv_path', type=str, help="output DICOM list (csv)")
+    args = ap.parse_args()
+
+    d = DcmCsvData()
+    d.save_csv(args.csv_path, d.read_compact(args.compact_path).astype(d.d_type))
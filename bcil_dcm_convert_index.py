@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# coding:utf-8
+import json
+import os
+import sqlite3
+from typing import Optional, List
+
+
+class DcmHeaderIndex:
+    # read_dcm_header の結果をファイル単位 (path, size, mtime, inode) で保持する
+
+    file_name: str = "bcil_dcm_header_index.sqlite"
+    schema_version: str = "1"  # table の形式を変更した場合は上げる
+
+    def __init__(self, parent_dir: str, extract_version: str):
+        # extract_version: header から取得する内容の版 (BcilDcmConvert.HEADER_EXTRACT_VERSION)
+        version = self.schema_version + "." + extract_version
+        self.path = os.path.join(parent_dir, self.file_name)
+        self.stats = {}
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:  # バージョンが異なる場合は作り直す
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute("DROP TABLE IF EXISTS series")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, status TEXT, "
+            "series_number INTEGER, instance_number INTEGER, series_uid TEXT, study_uid TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS series ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "series_row TEXT, study_row TEXT)")
+        self.conn.commit()
+
+    def file_stat(self, file: str) -> Optional[tuple]:
+        if file not in self.stats:
+            try:
+                st = os.stat(file)
+                self.stats[file] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            except OSError:
+                self.stats[file] = None
+        return self.stats[file]
+
+    def get_records(self, files: List[str]) -> list:
+        # 未登録・変更ありのファイルは None
+        records = []
+        for file in files:
+            stat = self.file_stat(file)
+            row = None
+            if stat is not None:
+                row = self.conn.execute(
+                    "SELECT status, series_number, instance_number, series_uid, study_uid FROM files "
+                    "WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?", (file,) + stat).fetchone()
+            records.append(None if row is None else (file,) + tuple(row))
+        return records
+
+    def put_records(self, records: List[tuple]):
+        with self.conn:
+            for file, status, series_number, instance_number, series_uid, study_uid in records:
+                stat = self.file_stat(file)
+                if stat is None:
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (file,) + stat + (status, series_number, instance_number, series_uid, study_uid))
+
+    def get_series(self, file: str) -> Optional[tuple]:
+        # series 代表ファイルの (series row, study row)
+        stat = self.file_stat(file)
+        if stat is None:
+            return None
+        row = self.conn.execute(
+            "SELECT series_row, study_row FROM series WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (file,) + stat).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put_series(self, file: str, series_row: dict, study_row: dict):
+        stat = self.file_stat(file)
+        if stat is None:
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?)",
+                (file,) + stat + (json.dumps(self.to_str_dict(series_row)), json.dumps(self.to_str_dict(study_row))))
+
+    @staticmethod
+    def to_str_dict(row: dict) -> dict:
+        # DataFrame 化の際に astype で元の値と同じになるよう str で保存する
+        return dict([(k, None if v is None else str(v)) for k, v in row.items()])
+
+    def close(self):
+        self.conn.close()
+
+
+class DcmAppendIndex:
+    # -w 2 (append) 用に保存先 csv のキーと最後の行の sort キーを csv の (size, mtime) と共に保持する
+
+    file_name: str = ".bcil_dcm_append_index.sqlite"
+    schema_version: str = "1"  # table の形式・キーの保存形式を変更した場合は上げる
+
+    def __init__(self, raw_data_dir: str):
+        version = self.schema_version
+        self.path = os.path.join(raw_data_dir, self.file_name)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:  # バージョンが異なる場合は作り直す
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute("DROP TABLE IF EXISTS keys")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, last_key TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS keys (name TEXT, k1, k2, PRIMARY KEY (name, k1, k2)) WITHOUT ROWID")
+        self.conn.commit()
+
+    @staticmethod
+    def file_stat(path: str) -> Optional[tuple]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def is_valid(self, name: str, path: str) -> bool:
+        # 前回の更新後に csv が変更されていないか
+        stat = self.file_stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns FROM files WHERE name = ?", (name,)).fetchone()
+        return stat is not None and row is not None and tuple(row) == stat
+
+    def file_size(self, name: str) -> Optional[int]:
+        # 前回の更新後の csv のサイズ
+        row = self.conn.execute("SELECT size FROM files WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def update_stat(self, name: str, path: str):
+        # csv を前回の更新後の内容に戻した場合に (size, mtime) のみ更新する
+        with self.conn:
+            self.conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE name = ?", self.file_stat(path) + (name,))
+
+    def last_key(self, name: str) -> Optional[list]:
+        row = self.conn.execute("SELECT last_key FROM files WHERE name = ?", (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def new_key_mask(self, name: str, keys: List[tuple]) -> List[bool]:
+        # 候補のキーを一時 table に入れ、保存済みのキーと 1 回の join で照合する
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_keys (i INTEGER PRIMARY KEY, k1, k2)")
+        self.conn.execute("DELETE FROM candidate_keys")
+        self.conn.executemany("INSERT INTO candidate_keys VALUES (?, ?, ?)",
+                              [(i,) + tuple(k) for i, k in enumerate(keys)])
+        found = set([row[0] for row in self.conn.execute(
+            "SELECT c.i FROM candidate_keys c JOIN keys k ON k.name = ? AND k.k1 = c.k1 AND k.k2 = c.k2", (name,))])
+        self.conn.execute("DELETE FROM candidate_keys")
+        self.conn.commit()
+        return [i not in found for i in range(len(keys))]
+
+    def rebuild(self, name: str, path: str, keys: List[tuple], last_key: Optional[list]):
+        with self.conn:
+            self.conn.execute("DELETE FROM keys WHERE name = ?", (name,))
+            self.put(name, path, keys, last_key)
+
+    def add(self, name: str, path: str, keys: List[tuple], last_key: Optional[list]):
+        with self.conn:
+            self.put(name, path, keys, last_key)
+
+    def put(self, name: str, path: str, keys: List[tuple], last_key: Optional[list]):
+        self.conn.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?, ?)", [(name,) + tuple(k) for k in keys])
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                          (name,) + self.file_stat(path) + (json.dumps(last_key),))
+
+    def close(self):
+        self.conn.close()
+
+
+class NiftiHashIndex:
+    # NIFTI の digest をファイル単位 (path, size, mtime, inode) で保持する
+
+    file_name: str = ".bcil_dcm_nifti_hash.sqlite"
+    schema_version: str = "1"  # table の形式・digest の算出方法を変更した場合は上げる
+
+    def __init__(self, parent_dir: str):
+        version = self.schema_version
+        self.path = os.path.join(parent_dir, self.file_name)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:  # バージョンが異なる場合は作り直す
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, digest TEXT)")
+        self.conn.commit()
+
+    def get_digest(self, path: str, stat: tuple) -> Optional[str]:
+        # 未登録・変更ありのファイルは None
+        row = self.conn.execute(
+            "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (path,) + stat).fetchone()
+        return None if row is None else row[0]
+
+    def put_digests(self, records: List[tuple]):
+        # records: (path, (size, mtime_ns, inode), digest)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                  [(path,) + stat + (digest,) for path, stat, digest in records])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# coding:utf-8
+import concurrent.futures
+import hashlib
+import json
+import os
+from typing import Optional, List
+
+from bcil_dcm_convert_index import NiftiHashIndex
+
+
+class NiftiMatcher:
+    # RawData の NIFTI に対応する BIDS の NIFTI を探す
+    # 1. dcm2niix の sidecar (json) の SeriesNumber / EchoNumber / ImageType / AcquisitionTime で対応付ける
+    # 2. 残りはサイズが同じファイルが他に無いものは hash を計算せずに対応付け、
+    #    サイズが重複するものだけ chunk 単位で読みながら並列に hash を計算する (結果は cache する)
+
+    chunk_size: int = 8 * 1024 * 1024
+    sidecar_keys: list = ["SeriesNumber", "EchoNumber", "ImageType", "AcquisitionTime"]
+
+    def __init__(self, cache_dir: Optional[str] = None, jobs: Optional[int] = None):
+        self.cache = NiftiHashIndex(cache_dir) if cache_dir is not None else None
+        self.jobs = max(1, jobs if jobs is not None else min(8, os.cpu_count() or 1))
+        self.hashed_count = 0  # 実際に hash を計算したファイル数
+        self.sidecar_count = 0  # sidecar で対応付けたファイル数
+
+    @staticmethod
+    def file_stat(path: str) -> Optional[tuple]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    @classmethod
+    def calc_digest(cls, path: str) -> str:
+        # ファイル全体をメモリに載せないよう、同じ buffer に chunk 単位で読み込む
+        h = hashlib.sha256()
+        buf = bytearray(cls.chunk_size)
+        view = memoryview(buf)
+        with open(path, mode="rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if n == 0:
+                    break
+                h.update(view[:n])
+        return h.hexdigest()
+
+    def get_digests(self, files: List[str], stats: dict) -> dict:
+        # path -> digest (cache に無いものは thread pool で計算する)
+        digests = {}
+        targets = []
+        for file in files:
+            digest = self.cache.get_digest(file, stats[file]) if self.cache is not None else None
+            if digest is None:
+                targets.append(file)
+            else:
+                digests[file] = digest
+        if len(targets) > 0:
+            # hashlib / ファイル読み込みは GIL を解放するため thread で並列化できる
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.jobs, len(targets))) as executor:
+                for file, digest in zip(targets, executor.map(self.calc_digest, targets)):
+                    digests[file] = digest
+            self.hashed_count += len(targets)
+            if self.cache is not None:
+                self.cache.put_digests([(f, stats[f], digests[f]) for f in targets])
+        return digests
+
+    @staticmethod
+    def get_sidecar_path(nifti_path: str) -> str:
+        for ext in [".nii.gz", ".nii"]:
+            if nifti_path.endswith(ext):
+                return nifti_path[:-len(ext)] + ".json"
+        return os.path.splitext(nifti_path)[0] + ".json"
+
+    @classmethod
+    def read_sidecar(cls, nifti_path: str) -> Optional[dict]:
+        try:
+            with open(cls.get_sidecar_path(nifti_path), mode="r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return sidecar if isinstance(sidecar, dict) else None
+
+    @classmethod
+    def get_sidecar_key(cls, sidecar: dict) -> Optional[tuple]:
+        if "SeriesNumber" not in sidecar:
+            return None
+        key = []
+        for k in cls.sidecar_keys:
+            v = sidecar.get(k)
+            key.append(tuple(v) if isinstance(v, list) else (str(v) if v is not None else None))
+        return tuple(key)
+
+    def match_sidecar(self, raw_data_files: List[str], bids_files: List[str],
+                      series_uids: Optional[dict] = None) -> dict:
+        # sidecar のキーが双方で一意に一致するものだけ対応付ける
+        # series_uids: RawData の NIFTI -> Series UID (Seriesinfo.csv)。BIDS 側の sidecar に
+        #              SeriesInstanceUID がある場合 (dcm2niix -ba n) はそれも照合する
+        bids_index = {}
+        for file in bids_files:
+            sidecar = self.read_sidecar(file)
+            key = self.get_sidecar_key(sidecar) if sidecar is not None else None
+            if key is not None:
+                bids_index.setdefault(key, []).append((file, sidecar.get("SeriesInstanceUID")))
+        candidates = {}
+        for file in raw_data_files:
+            sidecar = self.read_sidecar(file)
+            key = self.get_sidecar_key(sidecar) if sidecar is not None else None
+            if key is None or key not in bids_index:
+                continue
+            uid = (series_uids or {}).get(file, sidecar.get("SeriesInstanceUID"))
+            candidates[file] = [f for f, f_uid in bids_index[key] if f_uid is None or uid is None or f_uid == uid]
+        claimed = {}
+        for file, bids_list in candidates.items():
+            for f in bids_list:
+                claimed[f] = claimed.get(f, 0) + 1
+        result = {}
+        for file, bids_list in candidates.items():
+            if len(bids_list) == 1 and claimed[bids_list[0]] == 1:
+                result[file] = bids_list[0]
+        self.sidecar_count += len(result)
+        return result
+
+    def match(self, raw_data_files: List[str], bids_files: List[str], series_uids: Optional[dict] = None,
+              sidecar: bool = True) -> dict:
+        # RawData の NIFTI -> 対応する BIDS の NIFTI (見つからない場合は None)
+        raw_data_set = set(raw_data_files)
+        bids_files = [f for f in bids_files if f not in raw_data_set]
+        result = dict([(f, None) for f in raw_data_files])
+        if sidecar is True:
+            result.update(self.match_sidecar(raw_data_files, bids_files, series_uids))
+        matched_bids = set([f for f in result.values() if f is not None])
+        rest = self.match_content([f for f, v in result.items() if v is None],
+                                  [f for f in bids_files if f not in matched_bids])
+        result.update(dict([(f, v) for f, v in rest.items() if v is not None]))
+        return result
+
+    def match_content(self, raw_data_files: List[str], bids_files: List[str]) -> dict:
+        # RawData の NIFTI -> 同じ内容の BIDS の NIFTI (見つからない場合は None)
+        stats = {}
+        for file in list(dict.fromkeys(raw_data_files + bids_files)):
+            stats[file] = self.file_stat(file)
+        groups = {}  # size -> ([RawData], [BIDS])
+        for i, files in enumerate([raw_data_files, bids_files]):
+            for file in dict.fromkeys(files):
+                if stats[file] is not None:
+                    groups.setdefault(stats[file][0], ([], []))[i].append(file)
+
+        result = dict([(f, None) for f in raw_data_files])
+        hash_targets = []
+        for raw_list, bids_list in groups.values():
+            if len(raw_list) == 0 or len(bids_list) == 0:
+                continue
+            if len(raw_list) == 1 and len(bids_list) == 1:  # サイズが一意のものは hash 不要
+                result[raw_list[0]] = bids_list[0]
+            else:
+                hash_targets.extend(raw_list + bids_list)
+        if len(hash_targets) > 0:
+            digests = self.get_digests(list(dict.fromkeys(hash_targets)), stats)
+            bids_digests = {}
+            for file in bids_files:
+                if file in digests:
+                    bids_digests.setdefault(digests[file], file)  # 同じ内容のものは最初のファイル
+            for file in raw_data_files:
+                if file in digests and digests[file] in bids_digests:
+                    result[file] = bids_digests[digests[file]]
+        return result
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# coding:utf-8
+import concurrent.futures
+import datetime
+import json
+import os
+import signal
+import time
+import zipfile
+from typing import Optional
+
+from bcil_dcm_convert_batch import convert_subject, convert_subject_error, output_key, \
+    add_subject_options, get_subject_defaults
+
+
+class DcmWatcher:
+    # drop folder 直下のフォルダ / zip を 1 subject とし、一定時間更新が無くなったものから変換する
+
+    state_file_name: str = "bcil_dcm_watch_state.json"
+
+    def __init__(self, watch_dir: str, defaults: dict, parallel: int = 1, quiet_sec: float = 60,
+                 interval: float = 10, state_path: Optional[str] = None, invalid_polls: int = 3):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.defaults = defaults
+        self.parallel = max(1, parallel)
+        self.quiet_sec = quiet_sec
+        self.interval = interval
+        self.invalid_polls = max(1, invalid_polls)
+        self.state_path = state_path if state_path is not None else \
+            os.path.join(defaults["save_parent_dir"], self.state_file_name)
+        self.state = self.load_state()
+        self.candidates = {}  # path -> (signature, 最後に signature が変わった時刻)
+        self.invalid_counts = {}  # path -> 更新が無いまま不正な入力と判定された回数
+        self.running = {}  # future -> (path, output key, signature)
+        self.stop = False
+
+    def load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, mode="r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_state(self):
+        # 一時ファイルに書いてから置き換える
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def get_signature(path: str) -> tuple:
+        # (ファイル数, 合計サイズ, 最新の mtime)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            return 1, st.st_size, st.st_mtime_ns
+        count, size, mtime = 0, 0, os.stat(path).st_mtime_ns
+        stack = [path]
+        while len(stack) > 0:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime_ns)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        count, size, mtime = count + 1, size + st.st_size, max(mtime, st.st_mtime_ns)
+        return count, size, mtime
+
+    def poll(self) -> list:
+        # 更新が quiet_sec 以上無い未処理の入力
+        now = time.time()
+        running_paths = [p for p, k, sig in self.running.values()]
+        ready = []
+        found = set()
+        with os.scandir(self.watch_dir) as it:
+            entries = sorted([e for e in it if not e.name.startswith(".")], key=lambda e: e.name)
+        for entry in entries:
+            path = entry.path
+            if path in running_paths:
+                continue
+            if not entry.is_dir() and not entry.name.lower().endswith(".zip"):
+                continue
+            try:
+                signature = self.get_signature(path)
+            except OSError:  # 書き込み中に削除された場合など
+                continue
+            if self.is_processed(path, signature):
+                continue
+            found.add(path)
+            if path not in self.candidates or self.candidates[path][0] != signature:
+                self.candidates[path] = (signature, now)
+                self.invalid_counts.pop(path, None)
+                continue
+            if now - self.candidates[path][1] < self.quiet_sec:
+                continue
+            if path.lower().endswith(".zip") and not zipfile.is_zipfile(path):
+                # 不完全な zip は更新されるまで待ち、更新が無いまま invalid_polls 回続いた場合は failed とする
+                self.invalid_counts[path] = self.invalid_counts.get(path, 0) + 1
+                if self.invalid_counts[path] >= self.invalid_polls:
+                    del self.candidates[path], self.invalid_counts[path]
+                    self.record(path, signature, convert_subject_error({"dcm_dir_list": [path]}, "invalid zip file"))
+                continue
+            ready.append(path)
+        for path in [p for p in self.candidates if p not in found]:
+            del self.candidates[path]
+            self.invalid_counts.pop(path, None)
+        return ready
+
+    def is_processed(self, path: str, signature: tuple) -> bool:
+        # path と signature が state と一致する場合のみ処理済みとする (同名で再送されたものや更新された failed は再処理する)
+        if path not in self.state:
+            return False
+        if "Signature" not in self.state[path]:  # signature の無い以前の state は現在の内容を処理済みとする
+            self.state[path]["Signature"] = list(signature)
+            self.save_state()
+            return True
+        if tuple(self.state[path]["Signature"]) == signature:
+            return True
+        if path not in self.candidates:
+            self.log("changed: " + path)
+        return False
+
+    def submit_ready(self, executor: concurrent.futures.Executor):
+        busy_keys = set([k for p, k, sig in self.running.values()])
+        for path in self.poll():
+            if len(self.running) >= self.parallel:
+                break
+            params = dict(self.defaults)
+            params["dcm_dir_list"] = [path]
+            key = output_key(params)
+            if key is not None and key in busy_keys:
+                continue
+            busy_keys.add(key)
+            signature = self.candidates.pop(path)[0]
+            self.invalid_counts.pop(path, None)
+            self.running[executor.submit(convert_subject, params)] = (path, key, signature)
+            self.log("queued: " + path)
+
+    def collect_done(self, timeout: Optional[float]):
+        if len(self.running) == 0:
+            return
+        done, _ = concurrent.futures.wait(self.running, timeout=timeout,
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            path, key, signature = self.running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:  # worker process の異常終了など
+                result = convert_subject_error({"dcm_dir_list": [path]}, str(e))
+            self.record(path, signature, result)
+
+    def record(self, path: str, signature: tuple, result: dict):
+        # 処理済み (ok / failed) として処理時の signature と共に state に記録する
+        self.state[path] = {
+            "Signature": list(signature),
+            "Status": result["Status"],
+            "Message": result["Message"],
+            "Output": result["Output"],
+            "Finished": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "Elapsed[sec]": result["Elapsed[sec]"],
+        }
+        self.save_state()
+        self.log(result["Status"] + ": " + path + " > " + result["Output"] + " (" +
+                 str(result["Elapsed[sec]"]) + " sec) " + result["Message"])
+
+    def run(self, once: bool = False):
+        # once の場合は現在の入力を処理したら終了する
+        self.log("watching: " + self.watch_dir + " (state: " + self.state_path + ")")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.parallel, initializer=self.init_worker) as executor:
+            while self.stop is False:
+                self.submit_ready(executor)
+                if once is True and len(self.running) == 0 and len(self.candidates) == 0:
+                    break
+                if len(self.running) > 0:
+                    self.collect_done(self.interval)
+                else:
+                    time.sleep(self.interval)
+            while len(self.running) > 0:  # 終了時は変換中のものを待つ
+                self.collect_done(None)
+        self.log("stopped.")
+
+    @staticmethod
+    def init_worker():
+        # Ctrl-C (SIGINT) は watcher のみで受け、変換中の subject は最後まで実行する
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def request_stop(self, signum, frame):
+        self.log("stopping... (waiting for " + str(len(self.running)) + " subjects)")
+        self.stop = True
+
+    @staticmethod
+    def log(message: str):
+        print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + " : " + message, flush=True)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    usage = \
+        "\n\n" \
+        "  ex). $ python3 bcil_dcm_convert_watch.py [option(s)] <parent folder to save> <folder to watch>\n" \
+        "\n" \
+        "  each folder or zip file in <folder to watch> is converted as a subject, " \
+        "after it has not been changed for -q seconds.\n" \
+        "\n\n"
+    ap = ArgumentParser(usage=usage)
+    ap.add_argument('parent_dir', type=str, help="path to parent folder, to which output subject's folders will be saved")
+    ap.add_argument('watch_dir', type=str, help="folder to which DICOM folders or DICOM.zip files are delivered")
+    ap.add_argument('-P', '--parallel',
+                    dest='parallel', type=int, default=1,
+                    help="number of subjects converted at the same time (default is 1)", metavar="<num>")
+    ap.add_argument('-q', '--quiet',
+                    dest='quiet', type=float, default=60,
+                    help="seconds without changes before an input is converted (default is 60)", metavar="<sec>")
+    ap.add_argument('--interval',
+                    dest='interval', type=float, default=10,
+                    help="polling interval in seconds (default is 10)", metavar="<sec>")
+    ap.add_argument('--state',
+                    dest='state', type=str,
+                    help="path to state file (default is <parent folder>/" + DcmWatcher.state_file_name + ")",
+                    metavar="<json>")
+    ap.add_argument('--invalid_polls',
+                    dest='invalid_polls', type=int, default=3,
+                    help="number of polls an unchanged invalid input (e.g. a broken zip) is retried "
+                         "before it is recorded as failed (default is 3)", metavar="<num>")
+    ap.add_argument('--once',
+                    dest='once', action='store_true',
+                    help="exit after converting the current inputs")
+    add_subject_options(ap)
+    args = ap.parse_args()
+
+    for d, name in [(args.parent_dir, "<parent folder to save>"), (args.watch_dir, "<folder to watch>")]:
+        if not os.path.isdir(d):
+            print(name + " not found. (" + d + ")")
+            exit(1)
+
+    watcher = DcmWatcher(args.watch_dir, get_subject_defaults(args), args.parallel, args.quiet, args.interval,
+                         args.state, args.invalid_polls)
+    signal.signal(signal.SIGTERM, watcher.request_stop)
+    signal.signal(signal.SIGINT, watcher.request_stop)
+    watcher.run(once=args.once)
@@ -1,14 +1,15 @@
 #!/usr/bin/python3
 # coding:utf-8
 import warnings
-import re
 import decimal
 from typing import Optional, NoReturn, Union
 import pydicom
+from pydicom.tag import Tag
 import os
 from pydicom.errors import InvalidDicomError
 from collections import namedtuple
 import bcil_dcm_convert_logger
+import bcil_dcm_ascconv
 
 
 class BcilDcmKspaceInfo:
@@ -20,6 +21,9 @@ class BcilDcmKspaceInfo:
     ascii_data = None
     mri_identifier = None
 
+    # get_ds_val のキー(文字列)から解決済み Tag へのキャッシュ
+    tag_path_cache: dict = {}
+
     input_keys: list = [
         "real_dwell_time",
         "acquisition_matrix_text",
@@ -36,6 +40,17 @@ class BcilDcmKspaceInfo:
         "in_plane_phase_encodeing_direction",
         "image_orientation_patient",
     ]
+    # ascii text (ASCCONV) から取得するキー
+    ascii_keys: list = [
+        "sRXSPEC.alDwellTime[0]",
+        "sPat.lAccelFactPE",
+        "sWipMemBlock.alFree[13]",
+        "sProtConsistencyInfo.tBaselineString",
+        "sTXSPEC.asNucleusInfo[0].flReferenceAmplitude",
+        "ucFlipAngleMode",
+        "sKSpace.ucPhasePartialFourier",
+        "sKSpace.ucSlicePartialFourier",
+    ]
     output_keys: list = [
         "mri_identifier",
         "gradient",
@@ -53,10 +68,12 @@ class BcilDcmKspaceInfo:
         "slice_partial_fourier",
     ]
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, ds: Optional[pydicom.dataset.Dataset] = None):
 
         self.path = str(os.path.abspath(file_path))
-        if os.path.exists(self.path) and os.path.isfile(self.path):
+        if ds is not None:  # 読み込み済みの Dataset を利用する (file_path はログ用)
+            self.ds = ds
+        elif os.path.exists(self.path) and os.path.isfile(self.path):
             try:
                 self.ds = pydicom.read_file(self.path)
             except Exception as e:
@@ -238,16 +255,22 @@ class BcilDcmKspaceInfo:
         self.logger.warning("Warning: not found {}. no {} in ascii text.".format(name, key))
         return None
 
+    @classmethod
+    def resolve_tag_path(cls, keys: list) -> tuple:
+        path_key = tuple(keys)
+        if path_key not in cls.tag_path_cache:
+            cls.tag_path_cache[path_key] = tuple(Tag(key) for key in keys)
+        return cls.tag_path_cache[path_key]
+
     def get_ds_val(self, name: str, keys: list, type_str: str = "str") -> Union[list, str]:
-        count = 1
-        t = self.ds.copy()
-        for key in keys:
-            if key in t:
-                if type(t[key].value) == pydicom.sequence.Sequence:
-                    t = t[key].value[0]
+        # Dataset はコピーせずにそのまま辿る
+        t = self.ds
+        for tag in self.resolve_tag_path(keys):
+            if tag in t:
+                if type(t[tag].value) == pydicom.sequence.Sequence:
+                    t = t[tag].value[0]
                 else:
-                    t = t[key].value
-                count += 1
+                    t = t[tag].value
             else:
                 search = list(map(
                     lambda s: "(" + s[2:6] + "," + s[6:] + ")" if len(s) == 10 and s[:2] == "0x" else s, keys))
@@ -255,6 +278,8 @@ class BcilDcmKspaceInfo:
                 return None
         if type_str == "list":
             return list(t)
+        elif type_str == "raw":
+            return t
         else:
             return str(t)
 
@@ -450,22 +475,12 @@ class BcilDcmKspaceInfo:
 
     def set_ascii_txt(self, place: list) -> NoReturn:
 
-        raw_string = self.get_ds_val("ascii_text", place)
-        if raw_string is not None:
+        raw_value = self.get_ds_val("ascii_text", place, "raw")
+        if raw_value is not None:
             try:
-                m = re.findall(r"((### ASCCONV BEGIN)(.*?)(###\\n))(.*?)(\\n### ASCCONV END ###)", raw_string)
-                if len(m) == 0 or m[0][4] is not None:
-
-                    tmp = m[0]  # 1つめにHITしたものを利用します。
-                    ascconv = re.sub(r'\\n', "\n", tmp[4], 0, re.MULTILINE)
-                    ascconv = re.sub(r'\\t', "", ascconv, 0, re.MULTILINE)
-
-                    result = {}
-                    for line in ascconv.splitlines():
-                        tmp = line.split(r"=")
-                        if len(tmp) == 2:
-                            result[tmp[0].strip(" ").strip('"')] = tmp[1].strip(" ").strip('"')
-                    self.ascii_data = result
+                self.ascii_data = bcil_dcm_ascconv.parse_ascconv(raw_value, self.ascii_keys)
+                if self.ascii_data is None:
+                    self.logger.error("Error: cannot get ascii text. ASCCONV not found.")
             except Exception as e:
                 self.logger.error("Error: cannot get ascii text. " + str(e))
 